@@ -1,6 +1,7 @@
 import time
 from typing import Any
 import uuid
+from functools import cached_property, wraps
 from collections import OrderedDict, defaultdict
 from logging import Logger
 from tornado.escape import url_escape, json_decode
@@ -9,6 +10,9 @@ import tornado.auth
 import ujson as json
 from tornado.log import app_log
 from tornado.web import RequestHandler
+from components.basehandler.responsecache import store_response
+from components.basehandler.serializer import negotiate, serializers
+from components.database.mysqldb import MySqlDB
 from components.utils.log import ExtraLog
 
 def guid():
@@ -20,39 +24,99 @@ def strftime_ms(timestamp):
                      time.localtime(timestamp)), (timestamp * 1000) % 1000)
     return str
 
+
+_second_cache = (0, strftime_ms(0)[:19])
+
+def strftime_ms_cached(timestamp):
+    """strftime_ms with fixed width ms, the formatted seconds are cached, calls in the same second only format the ms"""
+    global _second_cache
+    second = int(timestamp)
+    if _second_cache[0] != second:
+        _second_cache = (second, time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(second)))
+    return '%s.%03d' % (_second_cache[1], (timestamp * 1000) % 1000)
+
+def transactional(method):
+    """Decorate the http method to run it in a transaction of self.db,
+    committed if the method returns, rolled back if it raises,
+    the connection is returned after the transaction ends even if the method called finish()"""
+    @wraps(method)
+    async def wrapper(self, *args, **kwargs):
+        async with self.db.transaction():
+            result = method(self, *args, **kwargs)
+            if result is not None:
+                result = await result
+        return result
+    return wrapper
+
+
 class DefaultHandler(RequestHandler):
 
+    # settings key of the config of self.db
+    db_config_key = 'mysql_config'
+    # serializer name of write(): json / msgpack..., None: by the Accept header, json if none supported
+    serializer = None
+    # set by @cache_response: the response is cached when finished
+    _response_cache = None
+
     def initialize(self):
         super().initialize()
         self.log = ExtraLog(self, app_log)
-        # convert request.header to defaultdict
-        self.headers = defaultdict(str, self.request.headers)
 
-        old_request_id = self.headers['request_id'].strip()
+        # only request_id/request_trace are needed eagerly (response headers and log extra),
+        # read them straight from request.headers; everything else is parsed on first access
+        headers = self.request.headers
+        old_request_id = headers.get('request_id', '').strip()
+        old_request_trace = headers.get('request_trace', '')
 
-        self.request_id = self.headers['request_id'] = guid().strip()
-        self.headers['request_trace'] = self.request_trace = ' '.join(
+        self.request_id = guid()
+        self.request_trace = ' '.join(
             filter(
                 lambda x: x.strip(),
                 [
-                    self.headers['request_trace'],
-                    '' if old_request_id in self.headers['request_trace'] else old_request_id,
-                    self.headers['request_id']
+                    old_request_trace,
+                    '' if old_request_id in old_request_trace else old_request_id,
+                    self.request_id
                 ])).strip()
 
-        content_type = self.headers['Content-Type']
-        if content_type in ('application/x-json', 'application/json'):
-            self.body_json = tornado.escape.json_decode(self.request.body)
-        else:
-            self.body_json = None
-
-        self.query_arguments = defaultdict(str, { key : self.get_query_argument(key,'') for key in self.request.query_arguments.keys()})
-        self.body_arguments = defaultdict(str, { key : self.get_body_argument(key,'') for key in self.request.body_arguments.keys()})
-        self.arguments = defaultdict(list, { key : self.get_argument(key,'') for key in self.request.arguments.keys()})
         # the first time call set_default_header is earlier than initialize, call it again
         self.set_default_headers()
         return
 
+    @cached_property
+    def headers(self):
+        """request.headers as defaultdict, with request_id/request_trace of current request"""
+        headers = defaultdict(str, self.request.headers)
+        headers['request_id'] = self.request_id
+        headers['request_trace'] = self.request_trace
+        return headers
+
+    @cached_property
+    def body_json(self):
+        if self.request.headers.get('Content-Type', '') in ('application/x-json', 'application/json'):
+            return json_decode(self.request.body)
+        return None
+
+    @cached_property
+    def query_arguments(self):
+        return defaultdict(str, { key : self.get_query_argument(key,'') for key in self.request.query_arguments.keys()})
+
+    @cached_property
+    def body_arguments(self):
+        return defaultdict(str, { key : self.get_body_argument(key,'') for key in self.request.body_arguments.keys()})
+
+    @cached_property
+    def arguments(self):
+        return defaultdict(list, { key : self.get_argument(key,'') for key in self.request.arguments.keys()})
+
+    @cached_property
+    def db(self):
+        """request scoped MySqlDB of settings[db_config_key], created on first use.
+        the connections are reused by all the queries of the request and returned to the pool in on_finish(),
+        see @transactional to run the request in a transaction
+        """
+        # a copy, change_db() must not change the settings
+        return MySqlDB(dict(self.settings[self.db_config_key] or {}))
+
     # Called at the beginning of a request before get/post/etc.
     async def prepare(self):
 
@@ -60,6 +124,10 @@ class DefaultHandler(RequestHandler):
 
     def on_finish(self):  # Called after the end of a request, the connection is closed, do any housekeeping here
         super().on_finish()
+        db = self.__dict__.get('db')
+        if db:
+            # finish() called in @transactional: released after commit / rollback
+            db.release(defer=True)
         return
 
     def get_current_user(self) -> Any:
@@ -77,7 +145,30 @@ class DefaultHandler(RequestHandler):
 
     # customize the output content
     def _request_summary(self) -> str:
-        body = self.body_json if self.body_json else self.body_arguments
+        if self.settings.get('access_log_format') == 'web_api_test':
+            return self._web_api_test_summary()
+        # compact: one line, fixed fields, request_trace is in the log prefix already
+        # start_time method uri status request_time(ms) remote_ip host port request_id handler
+        request = self.request
+        return '%s %s %s %d %.2fms %s %s %s %s %s.%s' % (
+            strftime_ms_cached(request._start_time),
+            request.method,
+            request.uri,
+            self.get_status(),
+            1000.0 * request.request_time(),
+            request.remote_ip,
+            request.host,
+            self.settings.get('port'),
+            self.request_id,
+            self.__module__, self.__class__.__name__)
+
+    # postman style request summary, can be imported as test case, for debug only
+    def _web_api_test_summary(self) -> str:
+        try:
+            body = self.body_json if self.body_json else self.body_arguments
+        except ValueError:
+            # body_json is parsed lazily, the first parse of a malformed body can be here: log it as is
+            body = self.request.body.decode('utf-8', 'replace')
         if body is dict:
             body = {key: url_escape(value) for (key, value) in body.items() if not key in (
                 'requestid', 'request_id', 'request_trace',)}
@@ -115,10 +206,29 @@ class DefaultHandler(RequestHandler):
         except Exception as e:
             return e
         
-    def write(self, data) -> None:        
-        super().write(json.dumps(data, indent=True) if data != None and type(data) == list else data)
+    def write(self, data) -> None:
+        """str / bytes are written as is, other data are serialized by the serializer of the request,
+        see components.basehandler.serializer, indented in debug mode only"""
+        if data is None or isinstance(data, (str, bytes)):
+            return super().write(data)
+        if self.serializer:
+            serializer = serializers[self.serializer]
+        else:
+            serializer = negotiate(self.request.headers.get('Accept'))
+            if len(serializers) > 1 and 'Accept' not in self._headers.get_list('Vary'):
+                self.add_header('Vary', 'Accept')
+        self.set_header('Content-Type', serializer.content_type)
+        super().write(serializer.dumps(data, pretty=bool(self.settings.get('debug'))))
             
 
+    def finish(self, chunk=None):
+        if self._response_cache and not self._headers_written:
+            if chunk is not None:
+                self.write(chunk)
+                chunk = None
+            store_response(self)
+        return super().finish(chunk)
+
     # customize the exception fallover handler
     def _handle_request_exception(self, e: BaseException) -> None:
         return super()._handle_request_exception(e)
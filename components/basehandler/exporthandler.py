@@ -0,0 +1,89 @@
+import csv
+import io
+
+from tornado.iostream import StreamClosedError
+
+from components.basehandler.serializer import serializers, to_primitive
+
+
+class ExportMixin():
+    """Write the rows of an async source (e.g. MySqlDB.iter_select) as NDJSON or CSV in chunks,
+    the memory used does not grow with the number of rows:
+        class OrderExportHandler(ExportMixin, DefaultHandler):
+            async def get(self):
+                await self.export(self.db.iter_select('select * from tblorder'), 'csv', 'orders.csv')
+    """
+
+    # bytes buffered before written to the client
+    export_chunk_size = 64 * 1024
+    _export_closed = False
+
+    async def export(self, rows, format='ndjson', filename=None, columns=None):
+        """`rows`: async iterable of dict / Row, or of lists of them (iter_select(as_chunks=True))
+        `format`: ndjson / csv
+        `filename`: sent as attachment if given
+        `columns`: csv columns, default: the keys of the first row
+        waits for the client to receive each chunk, stops and aclose() the source if the client disconnects.
+        return the number of rows written
+        """
+        if format not in ('ndjson', 'csv'):
+            raise ValueError('unknown export format %s' % format)
+        self.set_header('Content-Type', 'application/x-ndjson; charset=UTF-8' if format == 'ndjson'
+                        else 'text/csv; charset=UTF-8')
+        if filename:
+            self.set_header('Content-Disposition', 'attachment; filename="%s"' % filename)
+
+        dumps = serializers['json'].dumps
+        buffer, writer = io.StringIO(), None
+        row_count = 0
+        try:
+            async for item in rows:
+                if self._export_closed:
+                    break
+                for row in (item if isinstance(item, list) else (item,)):
+                    if format == 'ndjson':
+                        buffer.write(dumps(row if isinstance(row, dict) else dict(row)))
+                        buffer.write('\n')
+                    else:
+                        if writer is None:
+                            columns = list(columns if columns else row.keys())
+                            writer = csv.writer(buffer)
+                            writer.writerow(columns)
+                        writer.writerow([_csv_value(row.get(column)) for column in columns])
+                    row_count += 1
+                if buffer.tell() >= self.export_chunk_size:
+                    if not await self._export_chunk(buffer):
+                        break
+            else:
+                await self._export_chunk(buffer)
+        finally:
+            if hasattr(rows, 'aclose'):
+                # stop the query if not finished (client disconnected / error)
+                await rows.aclose()
+        return row_count
+
+    async def _export_chunk(self, buffer):
+        if self._export_closed:
+            return False
+        self.write(buffer.getvalue())
+        buffer.seek(0)
+        buffer.truncate()
+        try:
+            # resolved when the chunk is sent, a slow client slows down the reading of the rows
+            await self.flush()
+        except StreamClosedError:
+            self._export_closed = True
+        return not self._export_closed
+
+    def on_connection_close(self) -> None:
+        self._export_closed = True
+        super().on_connection_close()
+
+
+def _csv_value(value):
+    if value is None or isinstance(value, (str, int, float)):
+        return value
+    try:
+        return to_primitive(value)
+    except TypeError:
+        return str(value)
@@ -0,0 +1,169 @@
+"""Cache of rendered GET responses (status 200, headers, body) in an in-process LRU:
+
+    class PageHandler(UIHandler):
+        @cache_response(ttl=60, stale_ttl=300, vary_headers=('Accept-Language',))
+        def get(self):
+            self.render('page.html')
+
+a stale response (older than ttl, within stale_ttl) is served at once and refreshed in background by an
+internal request executed in this process. the ETag of the cached body answers If-None-Match with 304.
+the request headers named by the Vary header of the response (e.g. Vary: Accept set by DefaultHandler.write())
+are in the cache key too. responses setting cookies, Cache-Control private / no-store or Vary: * are not cached.
+
+put it below @tornado.web.authenticated, else a cached response is served without the login check:
+        @tornado.web.authenticated
+        @cache_response(ttl=60, vary_user=True)
+        def get(self):
+"""
+import time
+from functools import wraps
+
+from tornado import httputil
+from tornado.concurrent import Future
+
+from components.utils.lrucache import LRUCache
+
+# headers of a response not replayed from the cache
+_PER_RESPONSE_HEADERS = {'date', 'server', 'content-length', 'etag', 'set-cookie', 'request_id', 'request_trace'}
+
+_cache = None
+# keys being refreshed in background
+_revalidating = set()
+
+
+def response_cache(settings):
+    """the response cache of the process, `response_cache_size` bytes in settings"""
+    global _cache
+    if _cache is None:
+        _cache = LRUCache(settings.get('response_cache_size') or 64 * 1024 * 1024)
+    return _cache
+
+
+def cache_key(handler, vary_headers=(), vary_user=False):
+    request = handler.request
+    return (request.host, request.uri,
+            tuple(request.headers.get(name, '') for name in vary_headers),
+            handler.current_user if vary_user else None)
+
+
+def _variant_key(handler, key, vary):
+    """key of the response stored for `key` with the request headers `vary` of the response's Vary header"""
+    return key + (tuple(handler.request.headers.get(name, '') for name in vary),)
+
+
+def cache_response(ttl=60, stale_ttl=0, vary_headers=(), vary_user=False):
+    """Decorate the get() of a DefaultHandler to cache its response for `ttl` seconds.
+    `stale_ttl`: seconds an expired response is still served while it is refreshed in background
+    `vary_headers`: request headers in the cache key besides host / uri
+    `vary_user`: the current user is in the cache key, for pages rendered per user
+    must be below @tornado.web.authenticated, see the module doc
+    """
+    def decorator(method):
+        @wraps(method)
+        async def wrapper(self, *args, **kwargs):
+            cache = response_cache(self.settings)
+            key = cache_key(self, vary_headers, vary_user)
+            # the Vary header names of the response stored under key, then the response of the variant
+            vary = cache.get(key)
+            if vary is not None and not getattr(self.request, '_cache_revalidate', False):
+                variant = _variant_key(self, key, vary)
+                entry = cache.get(variant)
+                if entry:
+                    stale = time.time() >= entry['fresh_until']
+                    if stale:
+                        _revalidate(self, variant)
+                    _replay(self, entry, stale)
+                    return
+            # stored by DefaultHandler.finish()
+            self._response_cache = (cache, key, ttl, stale_ttl)
+            result = method(self, *args, **kwargs)
+            if result is not None:
+                await result
+        return wrapper
+    return decorator
+
+
+def store_response(handler):
+    """put the response of the handler into the cache, called before finish() writes it"""
+    cache, key, ttl, stale_ttl = handler._response_cache
+    handler._response_cache = None
+    headers = handler._headers
+    # cookies set by set_cookie() are added to the headers when flushed
+    if (handler.get_status() != 200 or 'Set-Cookie' in headers or getattr(handler, '_new_cookie', None)
+            or any(item in headers.get('Cache-Control', '') for item in ('private', 'no-store'))):
+        return
+    vary = tuple(sorted({name.strip().lower() for value in headers.get_list('Vary') for name in value.split(',')
+                         if name.strip()}))
+    if '*' in vary:
+        return
+    body = b''.join(handler._write_buffer)
+    now = time.time()
+    entry = {
+        'headers': [(name, value) for name, value in headers.get_all() if name.lower() not in _PER_RESPONSE_HEADERS],
+        'body': body,
+        # the same as the ETag tornado sets on the response
+        'etag': handler.compute_etag(),
+        'created': now,
+        'fresh_until': now + ttl,
+    }
+    cache.set(key, vary, ttl + stale_ttl, size=256)
+    cache.set(_variant_key(handler, key, vary), entry, ttl + stale_ttl, size=len(body) + 1024)
+
+
+def _replay(handler, entry, stale):
+    for name, value in entry['headers']:
+        handler.set_header(name, value)
+    handler.set_header('Etag', entry['etag'])
+    handler.set_header('Age', int(time.time() - entry['created']))
+    handler.set_header('X-Cache', 'STALE' if stale else 'HIT')
+    if handler.check_etag_header():
+        handler.set_status(304)
+    else:
+        handler.write(entry['body'])
+    handler.finish()
+
+
+class _RevalidateConnection(httputil.HTTPConnection):
+    """connection of the internal request refreshing a stale response, the output is dropped"""
+
+    def __init__(self, request) -> None:
+        self.context = getattr(request.connection, 'context', None)
+        self.finished = Future()
+
+    def set_close_callback(self, callback):
+        pass
+
+    def write_headers(self, start_line, headers, chunk=None):
+        return self._done()
+
+    def write(self, chunk):
+        return self._done()
+
+    def finish(self):
+        if not self.finished.done():
+            self.finished.set_result(None)
+
+    def _done(self):
+        future = Future()
+        future.set_result(None)
+        return future
+
+
+def _revalidate(handler, key):
+    """render the request again in background by an internal request, it stores the fresh response"""
+    if key in _revalidating:
+        return
+    request = handler.request
+    headers = httputil.HTTPHeaders(request.headers)
+    headers.pop('If-None-Match', None)
+    connection = _RevalidateConnection(request)
+    internal = httputil.HTTPServerRequest(method='GET', uri=request.uri, version=request.version, headers=headers,
+                                          host=request.host, connection=connection)
+    internal._cache_revalidate = True
+    _revalidating.add(key)
+    connection.finished.add_done_callback(lambda _: _revalidating.discard(key))
+    try:
+        handler.application.find_handler(internal).execute()
+    except Exception:
+        _revalidating.discard(key)
+        handler.log.exception('revalidate %s failed' % request.uri)
@@ -0,0 +1,127 @@
+"""Serializers of the response data written by DefaultHandler.write().
+
+json (default): compact ujson, rows from mysql (datetime / Decimal / bytes / Row / ColumnarResult) are converted
+natively, indented in debug only. Decimal is written as a string, a float would lose its precision,
+Row as an object by its column names.
+msgpack: if the msgpack package is installed, chosen by `Accept: application/msgpack` or the handler's `serializer`.
+register_serializer() adds more.
+"""
+import base64
+import datetime
+import decimal
+import json as std_json
+from array import array
+
+import ujson
+
+from components.database.resultset import ColumnarResult, Row
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+def to_primitive(obj):
+    """the json / msgpack compatible value of the types not supported natively, raise TypeError if unknown"""
+    if isinstance(obj, datetime.datetime):
+        return obj.isoformat(' ')
+    if isinstance(obj, (datetime.date, datetime.time)):
+        return obj.isoformat()
+    if isinstance(obj, datetime.timedelta):
+        # mysql TIME
+        return str(obj)
+    if isinstance(obj, decimal.Decimal):
+        return str(obj)
+    if isinstance(obj, (bytes, bytearray, memoryview)):
+        try:
+            return bytes(obj).decode('utf-8')
+        except UnicodeDecodeError:
+            return base64.b64encode(obj).decode('ascii')
+    if isinstance(obj, (set, frozenset)):
+        return list(obj)
+    if isinstance(obj, ColumnarResult):
+        return {'columns': obj.columns, 'data': obj.data}
+    if isinstance(obj, array) or hasattr(obj, 'tolist'):
+        # array / numpy array
+        return obj.tolist()
+    raise TypeError('%r is not serializable' % (obj,))
+
+
+# values prepare() converts or walks into
+_PREPARED = (dict, list, tuple, decimal.Decimal, ColumnarResult)
+
+
+def prepare(data):
+    """convert the values ujson / msgpack serialize natively without calling to_primitive:
+    Row (a tuple, would be an array) to a dict by its column names, Decimal (would be a float) to str
+    """
+    if isinstance(data, decimal.Decimal):
+        return str(data)
+    if isinstance(data, Row):
+        data = data.to_dict()
+    elif isinstance(data, ColumnarResult):
+        data = to_primitive(data)
+    if isinstance(data, dict):
+        return {key: prepare(value) if isinstance(value, _PREPARED) else value for key, value in data.items()}
+    if isinstance(data, (list, tuple)):
+        return [prepare(value) if isinstance(value, _PREPARED) else value for value in data]
+    return data
+
+
+try:
+    ujson.dumps(0, default=str)
+    _UJSON_DEFAULT = True
+except TypeError:
+    # ujson < 5.4 has no `default`
+    _UJSON_DEFAULT = False
+
+
+class JsonSerializer():
+    name = 'json'
+    content_type = 'application/json; charset=UTF-8'
+
+    def dumps(self, data, pretty=False):
+        indent = 2 if pretty else 0
+        data = prepare(data)
+        if _UJSON_DEFAULT:
+            return ujson.dumps(data, ensure_ascii=False, indent=indent, default=to_primitive)
+        try:
+            return ujson.dumps(data, ensure_ascii=False, indent=indent)
+        except TypeError:
+            return std_json.dumps(data, ensure_ascii=False, indent=indent or None, default=to_primitive,
+                                  separators=(',', ': ') if pretty else (',', ':'))
+
+
+class MsgpackSerializer():
+    name = 'msgpack'
+    content_type = 'application/msgpack'
+
+    def dumps(self, data, pretty=False):
+        # bytes are native in msgpack
+        return msgpack.packb(prepare(data), default=to_primitive, use_bin_type=True)
+
+
+# name -> serializer, media types of Accept header -> name
+serializers = {'json': JsonSerializer()}
+accept_types = {'application/json': 'json'}
+if msgpack:
+    serializers['msgpack'] = MsgpackSerializer()
+    accept_types.update({'application/msgpack': 'msgpack', 'application/x-msgpack': 'msgpack'})
+
+
+def register_serializer(serializer, media_types=()):
+    """add a serializer: an object with name / content_type / dumps(data, pretty)"""
+    serializers[serializer.name] = serializer
+    for media_type in media_types:
+        accept_types[media_type] = serializer.name
+
+
+def negotiate(accept, default='json'):
+    """the serializer of the first media type of the Accept header supported, `default` if none"""
+    if accept:
+        for item in accept.split(','):
+            name = accept_types.get(item.split(';')[0].strip().lower())
+            if name:
+                return serializers[name]
+    return serializers[default]
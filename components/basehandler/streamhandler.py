@@ -0,0 +1,299 @@
+import asyncio
+import codecs
+import json as std_json
+import os
+from collections import defaultdict
+from functools import cached_property
+
+import aiofiles
+import tornado.web
+from tornado.httputil import HTTPHeaders, _parse_header
+
+from components.basehandler.basehandler import DefaultHandler
+from components.utils.misc import createDirIfNotExists, guid
+
+
+class JsonArrayStream():
+    """Incremental parser of a json array: feed() the raw bytes, get back the completed items"""
+
+    def __init__(self) -> None:
+        self._decoder = std_json.JSONDecoder()
+        self._utf8 = codecs.getincrementaldecoder('utf-8')()
+        self._buffer = ''
+        self._started = False
+        self._after_value = False
+        self.finished = False
+
+    def feed(self, chunk, final=False):
+        buf = self._buffer + self._utf8.decode(chunk, final)
+        items, pos, size = [], 0, len(buf)
+        while True:
+            while pos < size and buf[pos] in ' \t\r\n':
+                pos += 1
+            if pos >= size:
+                break
+            if self.finished:
+                raise ValueError('extra data after the json array')
+            if not self._started:
+                if buf[pos] != '[':
+                    raise ValueError('json array expected')
+                self._started = True
+                pos += 1
+            elif buf[pos] == ']':
+                self.finished = True
+                pos += 1
+            elif self._after_value:
+                if buf[pos] != ',':
+                    raise ValueError('"," or "]" expected at %d' % pos)
+                self._after_value = False
+                pos += 1
+            else:
+                try:
+                    item, end = self._decoder.raw_decode(buf, pos)
+                except ValueError:
+                    if final:
+                        raise
+                    # item is not complete yet, wait for more data
+                    break
+                # a number at the end of buffer may continue in the next chunk ("23" + ".5")
+                if not final and type(item) in (int, float) and (end >= size or buf[end] not in ' \t\r\n,]'):
+                    break
+                items.append(item)
+                self._after_value = True
+                pos = end
+        self._buffer = buf[pos:]
+        if final and not self.finished:
+            raise ValueError('json array is not complete')
+        return items
+
+
+class MultipartStream():
+    """Incremental parser of multipart/form-data.
+    file parts are written into `upload_dir` as they arrive, other fields are kept in `fields`
+    """
+    MAX_HEADER_SIZE = 64 * 1024
+
+    def __init__(self, boundary, upload_dir) -> None:
+        self._delimiter = b'--' + boundary
+        self._part_end = b'\r\n' + self._delimiter
+        self._upload_dir = upload_dir
+        self._buffer = b''
+        self._state = 'preamble'
+        self._part = None
+        self._file = None
+        self.fields = defaultdict(str)
+        self.files = defaultdict(list)
+
+    @property
+    def finished(self):
+        return self._state == 'epilogue'
+
+    async def feed(self, chunk):
+        self._buffer += chunk
+        while True:
+            if self._state == 'preamble':
+                idx = self._buffer.find(self._delimiter)
+                if idx < 0:
+                    self._buffer = self._buffer[-len(self._delimiter):]
+                    return
+                self._buffer = self._buffer[idx + len(self._delimiter):]
+                self._state = 'delimiter'
+
+            elif self._state == 'delimiter':
+                if len(self._buffer) < 2:
+                    return
+                if self._buffer.startswith(b'--'):
+                    self._state = 'epilogue'
+                elif self._buffer.startswith(b'\r\n'):
+                    self._buffer = self._buffer[2:]
+                    self._state = 'headers'
+                else:
+                    raise ValueError('invalid multipart boundary')
+
+            elif self._state == 'headers':
+                idx = self._buffer.find(b'\r\n\r\n')
+                if idx < 0:
+                    if len(self._buffer) > MultipartStream.MAX_HEADER_SIZE:
+                        raise ValueError('multipart part header too large')
+                    return
+                await self._start_part(self._buffer[:idx].decode('utf-8'))
+                self._buffer = self._buffer[idx + 4:]
+                self._state = 'body'
+
+            elif self._state == 'body':
+                idx = self._buffer.find(self._part_end)
+                if idx < 0:
+                    # keep the tail, it may be the beginning of the next delimiter
+                    safe = len(self._buffer) - len(self._part_end) + 1
+                    if safe > 0:
+                        await self._write_part(self._buffer[:safe])
+                        self._buffer = self._buffer[safe:]
+                    return
+                await self._write_part(self._buffer[:idx])
+                await self._end_part()
+                self._buffer = self._buffer[idx + len(self._part_end):]
+                self._state = 'delimiter'
+
+            else:
+                # epilogue: ignore everything after the close delimiter
+                self._buffer = b''
+                return
+
+    async def _start_part(self, header_text):
+        headers = HTTPHeaders.parse(header_text)
+        disposition, params = _parse_header(headers.get('Content-Disposition', ''))
+        if disposition != 'form-data' or not params.get('name'):
+            raise ValueError('invalid multipart Content-Disposition')
+        self._part = {'name': params['name'], 'value': b''}
+        if 'filename' in params:
+            path = os.path.join(self._upload_dir, guid())
+            self._part.update({
+                'filename': params['filename'],
+                'content_type': headers.get('Content-Type', 'application/unknown'),
+                'path': path,
+                'size': 0,
+            })
+            self._file = await aiofiles.open(path, 'wb')
+
+    async def _write_part(self, data):
+        if not data:
+            return
+        if self._file:
+            await self._file.write(data)
+            self._part['size'] += len(data)
+        else:
+            self._part['value'] += data
+
+    async def _end_part(self):
+        part, self._part = self._part, None
+        if self._file:
+            await self._file.close()
+            self._file = None
+            del part['value']
+            self.files[part['name']].append(part)
+        else:
+            self.fields[part['name']] = part['value'].decode('utf-8')
+
+    async def abort(self):
+        """remove the files spooled so far when the upload is interrupted or rejected"""
+        paths = [part['path'] for parts in self.files.values() for part in parts]
+        if self._file:
+            await self._file.close()
+            self._file = None
+            paths.append(self._part['path'])
+        self.files.clear()
+        for path in paths:
+            if os.path.exists(path):
+                os.remove(path)
+
+
+@tornado.web.stream_request_body
+class StreamHandler(DefaultHandler):
+    """Handler receives the request body as a stream instead of buffering it in request.body.
+    multipart/form-data: file parts are spooled to `upload_dir`, see self.files / self.body_arguments
+    application/json: the body must be an array, items are passed to process_json_items() while uploading
+    call `await self.stream_result()` in the http method to wait for the whole body
+    """
+
+    # max items parsed but not consumed by process_json_items yet
+    json_queue_size = 1000
+    _json_stream = _multipart_stream = _json_consumer = _stream_error = None
+
+    async def prepare(self):
+        await super().prepare()
+        if self.settings.get('max_body_size'):
+            self.request.connection.set_max_body_size(self.settings['max_body_size'])
+
+        self.files = defaultdict(list)
+        content_type = self.request.headers.get('Content-Type', '')
+        if content_type.startswith(('application/x-json', 'application/json')):
+            self._json_stream = JsonArrayStream()
+            self._json_items = asyncio.Queue(maxsize=self.json_queue_size)
+            self._json_consumer = asyncio.ensure_future(self.process_json_items(self._iter_json_items()))
+        elif content_type.startswith('multipart/form-data'):
+            fields = _parse_header(content_type)[1]
+            if not fields.get('boundary'):
+                raise tornado.web.HTTPError(400, 'multipart boundary not found')
+            upload_dir = self.settings.get('upload_dir') or './upload'
+            createDirIfNotExists(upload_dir)
+            self._multipart_stream = MultipartStream(fields['boundary'].encode('latin1'), upload_dir)
+
+    async def data_received(self, chunk: bytes):
+        if self._stream_error:
+            return
+        try:
+            if self._json_stream:
+                for item in self._json_stream.feed(chunk):
+                    # waiting here stops reading the socket until process_json_items catches up
+                    await self._put_json_item(item)
+            elif self._multipart_stream:
+                await self._multipart_stream.feed(chunk)
+        except ValueError as e:
+            # drop the rest of body, the error is reported by stream_result()
+            self._stream_error = e
+            await self._abort()
+
+    @cached_property
+    def body_json(self):
+        # the body is never buffered, see stream_result()
+        return None
+
+    async def process_json_items(self, items):
+        """Consume the json array items (async iterator) while the body is still uploading,
+        the return value is returned by stream_result(). Override it to avoid keeping all items in memory.
+        """
+        return [item async for item in items]
+
+    async def _put_json_item(self, item):
+        # process_json_items may return without consuming all items, do not wait for it forever
+        if self._json_consumer.done():
+            return
+        put = asyncio.ensure_future(self._json_items.put(item))
+        await asyncio.wait((put, self._json_consumer), return_when=asyncio.FIRST_COMPLETED)
+        if not put.done():
+            put.cancel()
+
+    async def _iter_json_items(self):
+        while True:
+            item = await self._json_items.get()
+            if item is StopAsyncIteration:
+                return
+            yield item
+
+    async def stream_result(self):
+        """Wait for the whole body parsed
+        json: return the result of process_json_items()
+        multipart: return self.files, the fields are in self.body_arguments
+        """
+        if self._stream_error:
+            await self._abort()
+            raise tornado.web.HTTPError(400, 'invalid request body: %s' % self._stream_error)
+
+        if self._json_stream:
+            try:
+                for item in self._json_stream.feed(b'', final=True):
+                    await self._put_json_item(item)
+            except ValueError as e:
+                await self._abort()
+                raise tornado.web.HTTPError(400, 'invalid request body: %s' % e)
+            await self._put_json_item(StopAsyncIteration)
+            return await self._json_consumer
+
+        if self._multipart_stream:
+            if not self._multipart_stream.finished:
+                await self._abort()
+                raise tornado.web.HTTPError(400, 'multipart body is not complete')
+            self.files = self._multipart_stream.files
+            self.body_arguments = self._multipart_stream.fields
+            return self.files
+        return None
+
+    async def _abort(self):
+        if self._json_consumer and not self._json_consumer.done():
+            self._json_consumer.cancel()
+        if self._multipart_stream:
+            await self._multipart_stream.abort()
+
+    def on_connection_close(self) -> None:
+        super().on_connection_close()
+        asyncio.ensure_future(self._abort())
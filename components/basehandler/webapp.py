@@ -3,9 +3,11 @@
 
 import asyncio
 import logging
+import time
 from collections import defaultdict
 from datetime import datetime
 from typing import Any, List, Optional
+from urllib.parse import urlparse
 from tornado import httpclient
 
 import tornado.httpserver
@@ -19,6 +21,8 @@ from tornado.log import access_log
 from tornado.process import Subprocess
 from tornado.web import Application, RequestHandler
 
+from components.database.mysqldb import MySqlDB
+from components.utils.metrics import metrics
 from config.start_command import start_command
 
 
@@ -33,6 +37,13 @@ class IPAApplication(tornado.web.Application):
     #         logging.getLogger().info('[Scheduler Init]APScheduler has been started')
     #         self.scheduler = scheduler
 
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # set by prewarm() at startup
+        self.readiness = {'ready': True}
+        # requests with status < 400 per handler, for access log sampling
+        self._access_log_counter = defaultdict(int)
+
     def log_request(self, handler: RequestHandler) -> None:
         """Writes a completed HTTP request to the logs.
 
@@ -40,11 +51,15 @@ class IPAApplication(tornado.web.Application):
         this behavior either subclass Application and override this method,
         or pass a function in the application settings dictionary as
         ``log_function``.
+        4xx/5xx and slow requests are always logged, others are sampled, see ``sample_access_log``.
         """
-        log = ExtraLog(handler, access_log)
+        metrics.observe_request(handler)
         if "log_function" in self.settings:
             self.settings["log_function"](handler)
             return
+        if handler.get_status() < 400 and not self.sample_access_log(handler):
+            return
+        log = ExtraLog(handler, access_log)
         if handler.get_status() < 400:
             log_method = log.info
         elif handler.get_status() < 500:
@@ -53,6 +68,69 @@ class IPAApplication(tornado.web.Application):
             log_method = log.error
         log_method(handler._request_summary())
 
+    def sample_access_log(self, handler: RequestHandler) -> bool:
+        """Whether to log the request with status < 400.
+        Requests slower than ``access_log_slow_time`` (seconds, 0: disabled) are always logged,
+        others are logged 1 in ``access_log_sample_rate`` (0: never).
+        Both can be overridden per handler by ``access_log_route_config``:
+            {'module.HandlerClass': {'sample_rate': 100, 'slow_time': 0.5}}
+        """
+        name = '%s.%s' % (handler.__module__, handler.__class__.__name__)
+        route_config = (self.settings.get('access_log_route_config') or {}).get(name, {})
+
+        slow_time = route_config.get('slow_time', self.settings.get('access_log_slow_time'))
+        if slow_time and handler.request.request_time() >= slow_time:
+            return True
+
+        sample_rate = route_config.get('sample_rate', self.settings.get('access_log_sample_rate'))
+        if sample_rate is None or sample_rate == 1:
+            return True
+        if sample_rate <= 0:
+            return False
+        # log the 1st, (N+1)th, (2N+1)th ... request of each handler
+        count = self._access_log_counter[name]
+        self._access_log_counter[name] = count + 1
+        return count % sample_rate == 0
+
+    async def prewarm(self):
+        """Open the minsize connections to mysql (mysql_config and each shard of mysql_shards) in this process
+        before accepting requests, the result is kept in self.readiness for the readiness probe, retried later if failed.
+        """
+        self.readiness = {'ready': False, 'mysql': None, 'mysql_shards': {}}
+        config = self.settings.get('mysql_config')
+        shards = self.settings.get('mysql_shards') or {}
+        results = await asyncio.gather(self._prewarm_mysql('mysql', config) if config else asyncio.sleep(0),
+                                       *(self._prewarm_mysql('mysql shard %s' % name, shard_config)
+                                         for name, shard_config in shards.items()))
+        self.readiness['mysql'] = results[0]
+        self.readiness['mysql_shards'] = dict(zip(shards, results[1:]))
+
+        failed = [result for result in results if result and not result['ready']]
+        if failed:
+            retry = (config or next(iter(shards.values()))).get('pool_prewarm_retry', 5)
+            IOLoop.current().call_later(retry, self.prewarm)
+        self.readiness['ready'] = not failed
+        return self.readiness
+
+    async def _prewarm_mysql(self, name, config):
+        start_point = time.time()
+        try:
+            opened = await asyncio.wait_for(MySqlDB(config).prewarm(), config.get('pool_prewarm_timeout', 10))
+            result = {'ready': True, 'connections': opened}
+        except Exception as ex:
+            logging.getLogger().exception('%s prewarm failed' % name)
+            result = {'ready': False, 'error': str(ex)}
+        logging.getLogger().info('%s prewarm %s in %.3fs' % (name, result, time.time() - start_point))
+        return result
+
+    async def shutdown(self):
+        """Stop serving gracefully: not ready any more, insert the rows of the write behind buffers"""
+        self.readiness['ready'] = False
+        try:
+            await asyncio.wait_for(MySqlDB.close_write_behind(), self.settings.get('shutdown_timeout') or 30)
+        except Exception:
+            logging.getLogger().exception('shutdown error')
+
     async def run_command(self, command):    
         process = Subprocess(
             [command]
@@ -69,7 +147,8 @@ class IPAApplication(tornado.web.Application):
             try:
                 if item.startswith('http'):
                     http_client = httpclient.AsyncHTTPClient()
-                    response = await http_client.fetch(item)
+                    with metrics.timer('http_client_duration_seconds', host=urlparse(item).netloc):
+                        response = await http_client.fetch(item)
                     logging.getLogger().info(f"execute {item}\n{response.body}")                    
                 else:
                     await self.run_command(item)
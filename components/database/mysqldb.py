@@ -1,16 +1,31 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
 from collections import defaultdict
+import copy
+import os
 import re
+import tempfile
 import ujson as json
 import time
+import aiofiles
 import aiomysql
 import asyncio
+from contextlib import asynccontextmanager
 from components.database.mysqlpool import create_pool, Pool
+from components.database.querycache import QueryCache, normalize_sql, session_dependent, tables_of
+from components.database.resultset import make_result
+from components.database.sqlstats import sql_stats
+from components.database.writebehind import WriteBehind
 from components.utils.log import ExtraLog
+from components.utils.metrics import metrics
 from tornado.log import app_log
 from components.utils.misc import escape_string
 
+# a statement of a batch that is not a plain read, the batch goes to the primary
+_WRITE_RE = re.compile(r'(?:^|;)\s*(?:insert|update|delete|replace|create|drop|alter|truncate|rename|'
+                       r'set|use|call|lock|unlock|grant|revoke|load|start|begin|commit|rollback)\b', re.IGNORECASE)
+_USE_RE = re.compile(r'(?:^|;)\s*use\b', re.IGNORECASE)
+
 class DBProxyException(Exception):
     pass
 
@@ -130,6 +145,16 @@ class MySqlDB(object):
             return "'%s'" % escape_str
         return "'%s'" % str(escape_str)
 
+    @staticmethod
+    def escape_value(conn, val):
+        """sql literal of `val` escaped by the connection (charset / NO_BACKSLASH_ESCAPES aware), dict as json"""
+        if isinstance(val, dict):
+            val = json.dumps(val)
+        elif isinstance(val, (bytes, bytearray)):
+            # hex literal, aiomysql's escape of bytes fails with pymysql >= 1.1
+            return "X'%s'" % bytes(val).hex()
+        return conn.escape(val)
+
     @staticmethod
     def composeColValueSql(cols, vals, type='insert', makeupnull=False):
         hold_list = []
@@ -147,6 +172,28 @@ class MySqlDB(object):
                     hold_list.append("%s=%s" % (col, MySqlDB.val2SqlVal(None)))
         return ",".join(hold_list)
 
+    _query_cache = None
+
+    def query_cache(self):
+        """the result cache of exec_select, enabled by `query_cache_size` (bytes) in config"""
+        if MySqlDB._query_cache is None and self._config.get('query_cache_size'):
+            MySqlDB._query_cache = QueryCache(self._config['query_cache_size'], self._config.get('query_cache_ttl', 60))
+        return MySqlDB._query_cache
+
+    def _invalidate(self, sql):
+        """drop the cached selects of the tables written by `sql`, called after the write succeeds,
+        again at the end of the transaction if in one (other connections see the rows after commit)
+        """
+        query_cache = self.query_cache()
+        if query_cache:
+            tables = tables_of(sql)
+            query_cache.invalidate_tables(tables)
+            if self._in_transaction:
+                self._written_tables.update(tables)
+
+    def target_key(self):
+        return (self._config.get('host'), self._config.get('port'), self._config.get('db'), self._config.get('user'))
+
     _conn_pool = None
     _condition = asyncio.Condition()
     async def _ensure_pool(self):
@@ -156,33 +203,156 @@ class MySqlDB(object):
                 return MySqlDB._conn_pool
             if not self._config:
                 raise DBProxyRuntimeException('not provide correct config / uri to create db connection')
-            # config: host/port/user/password/db/charset/autocommit
-            self._config['charset'] = self._config.get('charset', 'utf8mb4')
-            self._config['autocommit'] = True if not 'autocommit' in self._config else self._config['autocommit']
             # 创建连接池，并确保有最小数量（缺省为1）的可用连接
             MySqlDB._conn_pool = await create_pool(
                                         maxsize=self._config.get('pool_max_size', 10),
                                         minsize=self._config.get('pool_min_size', 1),
                                         pool_recycle=self._config.get('pool_recycle_time',-1),
+                                        idle_timeout=self._config.get('pool_idle_timeout',-1),
+                                        reap_interval=self._config.get('pool_reap_interval',10),
+                                        acquire_timeout=self._config.get('pool_acquire_timeout',None),
+                                        share_db=self._config.get('pool_share_db',False),
                                         **self._config)
             return MySqlDB._conn_pool
 
-    async def get_conn(self):
+    async def prewarm(self):
+        """open pool_min_size connections of the primary and each replica, return the number of connections opened"""
+        pool = await self._ensure_pool()
+        opened = await pool.prewarm(**self._config)
+        for config in self.replica_configs():
+            opened += await pool.prewarm(**config)
+        return opened
+
+    async def get_conn(self, config=None, role='primary'):
+        """the connection of `role` (primary / replica) held by this object, `config` default: the primary"""
         if not self._conn_pool:
             self._conn_pool = await self._ensure_pool()
+        config = config if config else self._config
 
         # 配置没有改变，使用已有的连接
-        if self._conn and not self._conn.closed and self._conn_pool.config_key(self._conn) == self._conn_pool.config_key(**self._config):
-            return self._conn
+        conn = self._conns.get(role)
+        if conn and not conn.closed and self._conn_pool.config_key(conn) == self._conn_pool.config_key(**config):
+            # the dbs of a server share connections (pool_share_db): switch to the db of config if changed
+            await self._conn_pool.select_db(conn, config.get('db'))
+            return conn
 
         # 更换连接，归还到连接池
-        if self._conn:
-            self._conn_pool.release(self._conn)
-            self._conn = None
+        if conn:
+            self._release_conn(conn)
+            del self._conns[role]
         
         # 获取新的连接
-        self._conn = await self._conn_pool.acquire(**self._config)
-        return self._conn
+        self._conns[role] = await self._conn_pool.acquire(**config)
+        return self._conns[role]
+
+    # ---- read / write splitting ----
+    # round robin counter of replica selection
+    _replica_turn = 0
+
+    def replica_configs(self):
+        """config of each replica: the primary config overridden by the items of `replicas` in config,
+        e.g. 'replicas': [{'host': 'replica1'}, {'host': 'replica2', 'port': 3307}]
+        """
+        replicas = self._config.get('replicas')
+        if not replicas:
+            return []
+        if self._replicas is None or self._replicas[0] != self._config.get('db'):
+            configs = []
+            for replica in replicas:
+                config = dict(self._config, **replica)
+                config.pop('replicas', None)
+                configs.append(config)
+            self._replicas = (self._config.get('db'), configs)
+        return self._replicas[1]
+
+    def read_config(self, force_primary=False):
+        """config of the target serving the next select:
+        the primary if `force_primary`, in transaction, after a write of this object until release() (read your
+        writes, a replica may lag behind) or no replicas, else the replica in use or a new picked one
+        by `replica_strategy` in config: round_robin (default) / least_used (fewest connections in use of this process)
+        """
+        replicas = self.replica_configs()
+        if force_primary or self._in_transaction or self._wrote or not replicas:
+            return self._config
+        pool = self._conn_pool
+        conn = self._conns.get('replica')
+        if conn and not conn.closed:
+            key = pool.config_key(conn)
+            for config in replicas:
+                if pool.config_key(**config) == key:
+                    return config
+
+        MySqlDB._replica_turn += 1
+        start = MySqlDB._replica_turn % len(replicas)
+        replicas = replicas[start:] + replicas[:start]
+        if self._config.get('replica_strategy') == 'least_used':
+            return min(replicas, key=lambda config: len(pool.used(**config)) + pool.acquiring(**config))
+        return replicas[0]
+
+    async def get_read_conn(self, force_primary=False):
+        """connection for select, see read_config(), fall back to the primary if the replica can not be connected"""
+        if not self._conn_pool:
+            self._conn_pool = await self._ensure_pool()
+        config = self.read_config(force_primary)
+        if config is self._config:
+            return await self.get_conn()
+        try:
+            return await self.get_conn(config, 'replica')
+        except aiomysql.OperationalError as e:
+            if not self._config.get('replica_fallback', True):
+                raise
+            self.log.warning('replica %s:%s unavailable, read from primary: %s' % (config.get('host'), config.get('port'), e))
+            return await self.get_conn()
+
+    async def _timed_conn(self, read=False, force_primary=False):
+        """(connection, seconds waited for it), the pool wait / connect time is not counted as execute time"""
+        start_point = time.time()
+        conn = await (self.get_read_conn(force_primary) if read else self.get_conn())
+        acquire_time = time.time() - start_point
+        metrics.observe('db_acquire_duration_seconds', acquire_time)
+        return conn, acquire_time
+
+    @property
+    def in_transaction(self):
+        return self._in_transaction
+
+    async def begin(self):
+        """start a transaction on the primary connection, selects go to the primary until commit() / rollback()"""
+        conn = await self.get_conn()
+        await conn.begin()
+        self._in_transaction = True
+
+    async def commit(self):
+        """commit the transaction, raise DBProxyRuntimeException if its connection was lost (rolled back)"""
+        conn = self._conns.get('primary')
+        in_transaction, self._in_transaction = self._in_transaction, False
+        try:
+            if conn and not conn.closed:
+                await conn.commit()
+            elif in_transaction:
+                raise DBProxyRuntimeException('the connection of the transaction was lost, rolled back')
+        finally:
+            self._end_transaction()
+
+    async def rollback(self):
+        conn = self._conns.get('primary')
+        self._in_transaction = False
+        try:
+            if conn and not conn.closed:
+                await conn.rollback()
+        finally:
+            self._end_transaction()
+
+    @asynccontextmanager
+    async def transaction(self):
+        """`async with db.transaction():` commit if the block succeeds, rollback if it raises"""
+        await self.begin()
+        try:
+            yield self
+        except BaseException:
+            await self.rollback()
+            raise
+        await self.commit()
 
     def __init__(self, config={}, uri=""):
         """`uri`: the connect string to the Configure Server Database.
@@ -195,21 +365,89 @@ class MySqlDB(object):
         """        
         self.config(config, uri)
         self.log = ExtraLog(self, app_log)
-        self._conn = None
-        self._conn_pool = None        
+        # role (primary / replica) -> connection held
+        self._conns = {}
+        self._conn_pool = None
+        self._in_transaction = False
+        # release(defer=True) called in transaction: released when it ends
+        self._deferred_release = False
+        # tables written in the transaction, invalidated again when it ends
+        self._written_tables = set()
+        # a write was executed: the selects go to the primary until release()
+        self._wrote = False
 
     def config(self, config={}, uri=""):
         """`config`: json for connection config: host/port/user/password/db
+            `replicas`: list of replica configs overriding the primary's, selects are routed to them
         `uri`: odbc connection string
         """
         self._config = config if config else MySqlDB.parse_sqlalchemy_dburl(uri)
+        # every config (shards, replicas...) connects with them, not only the one creating the pool
+        if self._config:
+            self._config['charset'] = self._config.get('charset') or 'utf8mb4'
+            self._config['autocommit'] = True if not 'autocommit' in self._config else self._config['autocommit']
+        self._replicas = None
         
     def change_db(self, db):
         """`db` the next db to be used"""
         self._config['db'] = db
 
+    def release(self, defer=False):
+        """return the connections held to the pool, a transaction not committed is rolled back
+        (the pool closes the connection), the object can still be used, new connections are acquired
+        `defer`: in transaction, release when commit() / rollback() ends it instead
+        """
+        if defer and self._in_transaction:
+            self._deferred_release = True
+            return
+        self._deferred_release = False
+        self._written_tables.clear()
+        self._wrote = False
+        if self._in_transaction:
+            self.log.warning('release with the transaction not committed, rolled back')
+            self._in_transaction = False
+        conns, self._conns = self._conns, {}
+        for conn in conns.values():
+            self._release_conn(conn)
+
+    def _track_use(self, conn, sql):
+        """a USE statement changes the db of the connection behind the pool (use change_db() to select another db):
+        sharing the connections of the dbs (pool_share_db), forget the db select_db() tracks, the next one switches
+        again; else the connection is pooled by its db, it stays on the db for this object and is closed when released
+        """
+        if _USE_RE.search(sql):
+            if self._conn_pool._share_db:
+                conn._db = None
+            else:
+                conn._db_changed = True
+
+    def _release_conn(self, conn):
+        if getattr(conn, '_db_changed', False):
+            conn.close()
+        self._conn_pool.release(conn)
+
+    def _end_transaction(self):
+        if self._written_tables:
+            tables, self._written_tables = self._written_tables, set()
+            if self.query_cache():
+                self.query_cache().invalidate_tables(tables)
+        if self._deferred_release:
+            self.release()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        self.release()
+
     def __del__(self):
-        pass
+        # safety net, the connections should have been returned by release()
+        if self.__dict__.get('_conns'):
+            try:
+                self.log.warning('MySqlDB not released, %d connections returned by __del__' % len(self._conns))
+                self.release()
+            except Exception:
+                pass
 
     def format_params(self, param_list):
         return [ MySqlDB.val2SqlVal(parameter, None) for parameter in param_list ]
@@ -223,76 +461,265 @@ class MySqlDB(object):
     async def exec_sql(self, sql, params=None, commit=False):
         """Execute the SQL without fetch the result"""
         affect_rows = 0
-        
+        self._wrote = True
+        conn, acquire_time = await self._timed_conn()
         start_point = time.time()
-        conn = await self.get_conn()
-        async with conn.cursor(aiomysql.DictCursor) as cursor:
-            try:
-                affect_rows = await cursor.execute(sql, params)
-                if commit:
-                    await conn.commit()
-            except Exception as e:
-                self.log.exception('exec_modify_sql_no_fetch error:%s %s\tSQL TIME USAGE:%.3fs'
-                                    %(sql, e, time.time()-start_point))
-                await self.process_exception(conn,e)
-            self.log.info('%s\tSQL TIME USAGE:%.3fs affect_rows:%d' % (sql[:MySqlDB.SQL_PRINT_LEN], time.time()-start_point, affect_rows))
+        with metrics.timer('db_query_duration_seconds', operation='execute'):
+            async with conn.cursor(aiomysql.DictCursor) as cursor:
+                try:
+                    self._track_use(conn, sql)
+                    affect_rows = await cursor.execute(sql, params)
+                    if commit:
+                        await conn.commit()
+                except Exception as e:
+                    self.log.exception('exec_modify_sql_no_fetch error:%s %s\tSQL TIME USAGE:%.3fs'
+                                        %(sql, e, time.time()-start_point))
+                    sql_stats.record(sql, time.time() - start_point, error=True, slow_time=self._config.get('slow_query_time'),
+                                     acquire_time=acquire_time)
+                    await self.process_exception(conn,e)
+                self._invalidate(sql)
+                sql_stats.record(sql, time.time() - start_point, rows=affect_rows, slow_time=self._config.get('slow_query_time'),
+                                 acquire_time=acquire_time)
+                self.log.debug('%s\tSQL TIME USAGE:%.3fs affect_rows:%d acquire:%.3fs' % (
+                    sql[:MySqlDB.SQL_PRINT_LEN], time.time()-start_point, affect_rows, acquire_time))
         return
 
-    async def exec_select(self, sql, fetch_result=True):
+    async def exec_select(self, sql, fetch_result=True, params=None, cache=None, single_flight=None,
+                          result_mode='dict', use_numpy=False, force_primary=False):
         """Execute a SQL and return a list contains the result.
         `sql`: sql statement(s)
         `fetch_result`: whether fetch the result set if False the empty list will be return.
+        `params`: parameters of the sql
+        `cache`: False: bypass the query cache (see query_cache())
+        `single_flight`: identical selects running at the same time share one execution (each gets a copy
+            of the rows), default by `query_single_flight` in config, never for session dependent selects
+        `result_mode`: dict: list of dict rows
+                       rows: list of Row, tuples readable as dict: row['col'] / row.get('col') / dict(row)
+                       columns: ColumnarResult, column names + one array per column
+        `use_numpy`: numeric columns as numpy arrays in columns mode, if numpy is installed
+        `force_primary`: read from the primary instead of a replica and bypass the query cache,
+            selects in transaction or after a write of this object (see read_config()) always go to the primary
+            and are never cached / shared
         the row will be rebuild into dictionary;        
         """        
-        fetch_object_method_time_usage, execute_object_method_time_usage, start_point = 0, 0, time.time()
-        
-        conn = await self.get_conn()
-        async with conn.cursor(aiomysql.DictCursor) as cursor:                
-            rc = []
+        if _WRITE_RE.search(sql):
+            # a write run by exec_select goes to the primary, and the selects after it
+            self._wrote = True
+        # pinned to the primary: the cached rows / the rows of a leader may come from a lagging replica
+        is_select = (fetch_result and sql.lstrip()[:6].lower() == 'select' and not self._in_transaction
+                     and not self._wrote)
+        query_cache = (self.query_cache() if is_select and cache is not False and not force_primary
+                       and not session_dependent(sql) else None)
+        if query_cache:
+            cache_key = query_cache.key((self.target_key(), result_mode, use_numpy), sql, params)
+            rc = query_cache.get(cache_key)
+            if rc is not None:
+                return _copy_result(rc)
+            # a write finished while the select runs: the rows are not stored
+            generation = query_cache.generation(cache_key)
+
+        if single_flight is None:
+            single_flight = self._config.get('query_single_flight', False)
+        if is_select and single_flight and not session_dependent(sql):
+            rc = await self._select_single_flight(sql, params, result_mode, use_numpy, force_primary)
+        else:
+            rc = await self._select(sql, fetch_result, params, result_mode, use_numpy, force_primary)
+
+        if query_cache:
+            query_cache.set(cache_key, _copy_result(rc), generation=generation)
+        return rc
+
+    # (target, normalized sql, params) -> future of the rows, for single flight selects
+    _in_flight = {}
+
+    async def _select_single_flight(self, sql, params=None, result_mode='dict', use_numpy=False, force_primary=False):
+        key = (self.target_key(), normalize_sql(sql), repr(params), result_mode, use_numpy, force_primary)
+        leader = MySqlDB._in_flight.get(key)
+        if leader:
             try:
-                await cursor.execute(sql)                    
-                execute_object_method_time_usage = time.time() - start_point
-                start_point = time.time()
+                return _copy_result(await asyncio.shield(leader))
+            except asyncio.CancelledError:
+                # the leader was cancelled, not me: run it by myself
+                if not leader.cancelled():
+                    raise
+            return await self._select(sql, True, params, result_mode, use_numpy, force_primary)
+
+        leader = MySqlDB._in_flight[key] = asyncio.get_event_loop().create_future()
+        try:
+            rc = await self._select(sql, True, params, result_mode, use_numpy, force_primary)
+            leader.set_result(rc)
+            return _copy_result(rc)
+        except asyncio.CancelledError:
+            leader.cancel()
+            raise
+        except BaseException as e:
+            leader.set_exception(e)
+            # mark retrieved, no follower is not an error
+            leader.exception()
+            raise
+        finally:
+            del MySqlDB._in_flight[key]
+
+    async def _select(self, sql, fetch_result=True, params=None, result_mode='dict', use_numpy=False, force_primary=False):
+        conn, acquire_time = await self._timed_conn(True, force_primary)
+        fetch_object_method_time_usage, execute_object_method_time_usage, start_point = 0, 0, time.time()
+        with metrics.timer('db_query_duration_seconds', operation='select'):
+            async with conn.cursor(aiomysql.DictCursor if result_mode == 'dict' else aiomysql.Cursor) as cursor:
+                rc = []
+                try:
+                    self._track_use(conn, sql)
+                    await cursor.execute(sql, params)
+                    execute_object_method_time_usage = time.time() - start_point
+                    start_point = time.time()
                 
-                if fetch_result:
-                    # rc = cursor.fetchall()
-                    rc = []
+                    if fetch_result:
+                        # rc = cursor.fetchall()
+                        rc = []
+                        while True:
+                            many = await cursor.fetchmany(1000)
+                            if not many:
+                                break
+                            rc.extend(many)
+                            await asyncio.sleep(0)
+                        if len(rc)>20000:
+                            self.log.info("allow_large_data--Surch result count more than 20000")
+                        if result_mode != 'dict':
+                            columns = [item[0] for item in cursor.description] if cursor.description else []
+                            rc = make_result(columns, rc, result_mode, use_numpy)
+                    fetch_object_method_time_usage = time.time() - start_point
+                except Exception as e:
+                    self.log.exception('exec_select error:%s %s\tSQL TIME USAGE:%.3fs'
+                                        %(sql, e, time.time()-start_point))
+                    sql_stats.record(sql, execute_object_method_time_usage or time.time() - start_point,
+                                     error=True, slow_time=self._config.get('slow_query_time'), acquire_time=acquire_time)
+                    await self.process_exception(conn, e)
+
+        sql_stats.record(sql, execute_object_method_time_usage, fetch_object_method_time_usage, len(rc),
+                         slow_time=self._config.get('slow_query_time'), acquire_time=acquire_time)
+        self.log.debug('%s\tTIME USAGE: SQL Execute:%.3fs Fetch Result:%.3fs Acquire:%.3fs'
+            %(sql[:MySqlDB.SQL_PRINT_LEN], execute_object_method_time_usage, fetch_object_method_time_usage, acquire_time))
+        return rc
+
+    async def exec_multi(self, sql, params=None, result_mode='dict', use_numpy=False, force_primary=False):
+        """Execute several statements separated by ; in one round trip and return the result set of each statement.
+        `sql`: statements, e.g. 'select * from tblorder where oid=%s; select * from tblorderitem where order_id=%s'
+        `params`: parameters of all the statements
+        `result_mode`, `use_numpy`: see exec_select, applied to each result set
+        `force_primary`: batches of reads only go to a replica by default, batches with writes always go to the primary
+        return list of the result sets in the order of the statements, [] for a statement without result set
+        """
+        write = bool(_WRITE_RE.search(sql))
+        self._wrote = self._wrote or write
+        conn, acquire_time = await self._timed_conn(not write, force_primary)
+        fetch_object_method_time_usage, execute_object_method_time_usage, start_point = 0, 0, time.time()
+        results, row_count = [], 0
+        with metrics.timer('db_query_duration_seconds', operation='multi'):
+            async with conn.cursor(aiomysql.DictCursor if result_mode == 'dict' else aiomysql.Cursor) as cursor:
+                try:
+                    self._track_use(conn, sql)
+                    await cursor.execute(sql, params)
+                    execute_object_method_time_usage = time.time() - start_point
+                    start_point = time.time()
                     while True:
-                        many = await cursor.fetchmany(1000)
-                        if not many:
+                        rc = []
+                        if cursor.description:
+                            while True:
+                                many = await cursor.fetchmany(1000)
+                                if not many:
+                                    break
+                                rc.extend(many)
+                                await asyncio.sleep(0)
+                            if result_mode != 'dict':
+                                rc = make_result([item[0] for item in cursor.description], rc, result_mode, use_numpy)
+                        results.append(rc)
+                        row_count += len(rc)
+                        # the error of a later statement is raised here
+                        if not await cursor.nextset():
                             break
-                        rc.extend(many)
-                        await asyncio.sleep(0)
-                    if len(rc)>20000:
-                        self.log.info("allow_large_data--Surch result count more than 20000")
-                fetch_object_method_time_usage = time.time() - start_point
+                    fetch_object_method_time_usage = time.time() - start_point
+                except Exception as e:
+                    self.log.exception('exec_multi error:%s %s\tSQL TIME USAGE:%.3fs'
+                                        %(sql, e, time.time()-start_point))
+                    sql_stats.record(sql, execute_object_method_time_usage or time.time() - start_point,
+                                     error=True, slow_time=self._config.get('slow_query_time'), acquire_time=acquire_time)
+                    await self.process_exception(conn, e)
+
+        if write:
+            self._invalidate(sql)
+        sql_stats.record(sql, execute_object_method_time_usage, fetch_object_method_time_usage, row_count,
+                         slow_time=self._config.get('slow_query_time'), acquire_time=acquire_time)
+        self.log.debug('%s\tTIME USAGE: SQL Execute:%.3fs Fetch Result:%.3fs Acquire:%.3fs result sets:%d'
+            %(sql[:MySqlDB.SQL_PRINT_LEN], execute_object_method_time_usage, fetch_object_method_time_usage,
+              acquire_time, len(results)))
+        return results
+
+    async def iter_select(self, sql, params=None, chunk_size=1000, as_chunks=False, force_primary=False):
+        """Execute a SQL and yield the rows as they arrive, the result set is not buffered (SSDictCursor).
+        `chunk_size`: rows fetched from the server each time
+        `as_chunks`: yield lists of up to `chunk_size` rows instead of single rows
+        a dedicated connection is held until the iteration ends, exhaust the generator or aclose() it
+        (e.g. `async with contextlib.aclosing(db.iter_select(sql)) as rows:`) to return it in time.
+        `force_primary`: read from the primary instead of a replica
+        not allowed in a transaction: the rows written by it are not visible on the dedicated connection.
+        """
+        if self._in_transaction:
+            raise DBProxyRuntimeException('iter_select can not run in a transaction, use exec_select')
+        pool = self._conn_pool = self._conn_pool if self._conn_pool else await self._ensure_pool()
+        acquire_point = time.time()
+        conn = await pool.acquire(**self.read_config(force_primary))
+        start_point, row_count, completed, execute_time = time.time(), 0, False, 0
+        metrics.observe('db_acquire_duration_seconds', start_point - acquire_point)
+        try:
+            cursor = await conn.cursor(aiomysql.SSDictCursor)
+            try:
+                await cursor.execute(sql, params)
+                execute_time = time.time() - start_point
+                while True:
+                    many = await cursor.fetchmany(chunk_size)
+                    if not many:
+                        break
+                    row_count += len(many)
+                    if as_chunks:
+                        yield many
+                    else:
+                        for row in many:
+                            yield row
+                completed = True
             except Exception as e:
-                self.log.exception('exec_select error:%s %s\tSQL TIME USAGE:%.3fs'
+                self.log.exception('iter_select error:%s %s\tSQL TIME USAGE:%.3fs'
                                     %(sql, e, time.time()-start_point))
                 await self.process_exception(conn, e)
-
-        self.log.info('%s\tTIME USAGE: SQL Execute:%.3fs Fetch Result:%.3fs'
-            %(sql[:MySqlDB.SQL_PRINT_LEN], execute_object_method_time_usage, fetch_object_method_time_usage))
-        return rc
+            finally:
+                if completed:
+                    await cursor.close()
+        finally:
+            if not completed:
+                # the unread rows are still on the wire, closing is cheaper than draining them
+                conn.close()
+            pool.release(conn)
+            metrics.observe('db_query_duration_seconds', time.time() - start_point,
+                            operation='iter_select', result='ok' if completed else 'error')
+            # fetch time includes the time the consumer spent on the rows
+            sql_stats.record(sql, execute_time, time.time() - start_point - execute_time, row_count,
+                             error=not completed, slow_time=self._config.get('slow_query_time'),
+                             acquire_time=start_point - acquire_point)
+            self.log.debug('%s\tTIME USAGE: %.3fs rows:%d%s' % (sql[:MySqlDB.SQL_PRINT_LEN],
+                time.time() - start_point, row_count, '' if completed else ' (stopped)'))
 
     async def call_procedure(self, proc_name, parameters=[], fetch_result=True,allow_large_data=True):
         """Call a store procedure and return a list contains the results.
-        `as_dict_flag`: the row will be rebuild into dictionary;
         `fetch_result`: whether fetch the result set if False the empty list will be return.
+        `allow_large_data`: False: raise DBProxyRuntimeException if the result has more than 50000 rows
+        runs on the primary connection held by this object (the one of the transaction if in one)
         """
+        self._wrote = True
+        conn, acquire_time = await self._timed_conn()
         fetch_object_method_time_usage, execute_object_method_time_usage, start_point = 0, 0, time.time()
-        async with (await self.get_conn()) as conn:
-            async with conn.cursor(aiomysql.DictCursor) as cursor:        
+        with metrics.timer('db_query_duration_seconds', operation='callproc'):
+            async with conn.cursor(aiomysql.DictCursor) as cursor:
                 rc = []
                 try:
-                    self.change_database(cursor)
-                    if allow_large_data:
-                        await conn.set_limit_count(0)
-                    else:
-                        await conn.set_limit_count(50000)
                     result_args = await cursor.callproc(proc_name, parameters)
-                    if await conn.get_out_of_limit_count_status():
-                        raise DBProxyRuntimeException("allow_large_data--Surch result count more than 50000")
                     self.log.warning("%s result_args:%s" % (proc_name, result_args))
                     execute_object_method_time_usage = time.time() - start_point
                     start_point = time.time()
@@ -302,6 +729,8 @@ class MySqlDB(object):
                         if not many:
                             break
                         rc.extend(many)
+                        if not allow_large_data and len(rc) > 50000:
+                            raise DBProxyRuntimeException("allow_large_data--Surch result count more than 50000")
                         await asyncio.sleep(0)
 
                     if len(rc)>20000:
@@ -310,35 +739,182 @@ class MySqlDB(object):
                         rc = rc[0]
                     if not fetch_result:
                         rc = []
-                    fetch_object_method_time_usage = time.time() - start_point                    
+                    fetch_object_method_time_usage = time.time() - start_point
+                except DBProxyRuntimeException:
+                    raise
                 except Exception as e:
                     self.log.exception('callproc error:%s %s\tSQL TIME USAGE:%.3fs'
                                     %(proc_name, e, time.time()-start_point))
+                    sql_stats.record('call %s' % proc_name, time.time() - start_point, error=True,
+                                     slow_time=self._config.get('slow_query_time'), acquire_time=acquire_time)
                     await self.process_exception(conn, e)
 
-        self.log.info('exec %s %s\tTIME USAGE: SQL Execute:%.3fs Fetch Result:%.3fs'
+        sql_stats.record('call %s' % proc_name, execute_object_method_time_usage, fetch_object_method_time_usage,
+                         len(rc), slow_time=self._config.get('slow_query_time'), acquire_time=acquire_time)
+        self.log.debug('exec %s %s\tTIME USAGE: SQL Execute:%.3fs Fetch Result:%.3fs'
             %(proc_name, parameters, execute_object_method_time_usage, fetch_object_method_time_usage))
         return rc
 
     async def executemany(self, oper_sql, sql_of_params, commit=False):
-        """Call executemany() function.
-        `as_dict_flag`: the row will be rebuild into dictionary;
-        `fetch_result`: whether fetch the result set if False the empty list will be return.
+        """Execute the statement once per parameters of `sql_of_params`,
+        on the primary connection held by this object (the one of the transaction if in one)
         """
+        self._wrote = True
+        conn, acquire_time = await self._timed_conn()
         execute_object_method_time_usage, start_point = 0, time.time()
-        async with  (await self.get_conn()) as conn:
-            async with conn.cursor(aiomysql.DictCursor) as cursor:        
+        with metrics.timer('db_query_duration_seconds', operation='executemany'):
+            async with conn.cursor(aiomysql.DictCursor) as cursor:
                 try:
-                    self.change_database(cursor)
                     await cursor.executemany(oper_sql, sql_of_params)
                     if commit:
                         await conn.commit()
-                    execute_object_method_time_usage = time.time() - start_point                    
+                    execute_object_method_time_usage = time.time() - start_point
                 except Exception as e:
-                    
                     self.log.exception('executemany error:%s params:%s %s\tSQL TIME USAGE:%.3fs'
                                     %(oper_sql, sql_of_params, e, time.time()-start_point))
+                    sql_stats.record(oper_sql, time.time() - start_point, error=True,
+                                     slow_time=self._config.get('slow_query_time'), acquire_time=acquire_time)
                     await self.process_exception(conn, e)
 
-        self.log.info('%s params len=%d\tTIME USAGE: SQL Execute:%.3fs' %
+        self._invalidate(oper_sql)
+        sql_stats.record(oper_sql, execute_object_method_time_usage, rows=len(sql_of_params),
+                         slow_time=self._config.get('slow_query_time'), acquire_time=acquire_time)
+        self.log.debug('%s params len=%d\tTIME USAGE: SQL Execute:%.3fs' %
             (oper_sql, len(sql_of_params), execute_object_method_time_usage))
+
+    @staticmethod
+    def val2InfileVal(val):
+        """value in the default LOAD DATA format: tab separated, backslash escaped, \\N for null"""
+        if val is None:
+            return '\\N'
+        if isinstance(val, bool):
+            return '1' if val else '0'
+        if isinstance(val, dict):
+            val = json.dumps(val)
+        return str(val).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r').replace('\0', '\\0')
+
+    async def max_allowed_packet(self):
+        rc = await self._select('select @@max_allowed_packet as max_allowed_packet', force_primary=True)
+        return int(rc[0]['max_allowed_packet'])
+
+    async def bulk_insert(self, table, rows, cols=None, upsert=False, update_cols=None,
+                          max_packet=None, commit=False, local_infile=False):
+        """Insert rows by multi-row INSERT ... VALUES (...),(...) statements.
+        `rows`: iterable or async iterable of dict
+        `cols`: columns to insert, default: the keys of the first row, missing values are inserted as null
+        `upsert`: add ON DUPLICATE KEY UPDATE col=VALUES(col) for `update_cols` (default: all the cols)
+        `max_packet`: max bytes of one statement, default: 90% of the server's max_allowed_packet
+        `local_infile`: write the rows into a file and LOAD DATA LOCAL INFILE it (needs local_infile=True in config),
+            `upsert` becomes REPLACE, update_cols is ignored
+        return {'rows':, 'statements':, 'seconds':, 'rows_per_second':}
+        """
+        start_point, row_count, statement_count = time.time(), 0, 0
+        if local_infile:
+            row_count, statement_count = await self._bulk_load_infile(table, rows, cols, upsert, commit)
+        else:
+            if not max_packet:
+                max_packet = int(await self.max_allowed_packet() * 0.9)
+            head = tail = None
+            values, values_size = [], 0
+            async for row in _aiter(rows):
+                if head is None:
+                    # the values are escaped by the connection the statements run on
+                    conn = await self.get_conn()
+                    cols = cols if cols else list(row.keys())
+                    head = 'INSERT INTO %s(%s) VALUES ' % (table, ','.join(cols))
+                    tail = '' if not upsert else ' ON DUPLICATE KEY UPDATE ' + ','.join(
+                        ['%s=VALUES(%s)' % (col, col) for col in (update_cols if update_cols else cols)])
+                    limit = max_packet - len(head.encode('utf-8')) - len(tail.encode('utf-8'))
+                value = '(%s)' % ','.join([MySqlDB.escape_value(conn, row.get(col)) for col in cols])
+                size = len(value.encode('utf-8')) + 1
+                if values and values_size + size > limit:
+                    await self.exec_sql(head + ','.join(values) + tail, commit=commit)
+                    statement_count += 1
+                    values, values_size = [], 0
+                values.append(value)
+                values_size += size
+                row_count += 1
+            if values:
+                await self.exec_sql(head + ','.join(values) + tail, commit=commit)
+                statement_count += 1
+
+        seconds = time.time() - start_point
+        result = {'rows': row_count, 'statements': statement_count, 'seconds': round(seconds, 3),
+                  'rows_per_second': round(row_count / seconds, 1) if seconds > 0 else row_count}
+        self.log.info('bulk_insert %s %s' % (table, result))
+        return result
+
+    async def _bulk_load_infile(self, table, rows, cols, replace, commit):
+        row_count = 0
+        fd, path = tempfile.mkstemp(suffix='.tsv')
+        os.close(fd)
+        try:
+            async with aiofiles.open(path, 'w', encoding='utf-8') as f:
+                lines = []
+                async for row in _aiter(rows):
+                    cols = cols if cols else list(row.keys())
+                    lines.append('\t'.join([MySqlDB.val2InfileVal(row.get(col)) for col in cols]))
+                    row_count += 1
+                    if len(lines) >= 1000:
+                        await f.write('\n'.join(lines) + '\n')
+                        lines = []
+                if lines:
+                    await f.write('\n'.join(lines) + '\n')
+            if row_count:
+                await self.exec_sql("LOAD DATA LOCAL INFILE '%s' %sINTO TABLE %s CHARACTER SET utf8mb4 (%s)"
+                                    % (path, 'REPLACE ' if replace else '', table, ','.join(cols)), commit=commit)
+                if self.query_cache():
+                    self.query_cache().invalidate_tables([table])
+        finally:
+            os.remove(path)
+        return row_count, 1 if row_count else 0
+
+    # target -> write behind buffer of the target
+    _write_behinds = {}
+
+    def write_behind(self):
+        """the write behind buffer of current target (one per process), see WriteBehind,
+        configured by write_behind_batch_size / write_behind_max_latency / write_behind_max_rows in config
+        """
+        key = self.target_key()
+        buffer = MySqlDB._write_behinds.get(key)
+        if buffer is None:
+            config = dict(self._config)
+            buffer = MySqlDB._write_behinds[key] = WriteBehind(
+                lambda: MySqlDB(config),
+                batch_size=self._config.get('write_behind_batch_size', 500),
+                max_latency=self._config.get('write_behind_max_latency', 1.0),
+                max_rows=self._config.get('write_behind_max_rows', 50000))
+        return buffer
+
+    async def insert_behind(self, table, row, block=True):
+        """queue the dict `row`, it is inserted into `table` later in batch by the write behind buffer.
+        the row is not in the table yet when it returns, for records not read back at once (events, logs...)
+        `block`: wait if the buffer of the table is full, False: raise asyncio.QueueFull
+        """
+        await self.write_behind().put(table, row, block)
+
+    @staticmethod
+    async def close_write_behind():
+        """insert all the rows queued by insert_behind(), call it at shutdown"""
+        buffers = list(MySqlDB._write_behinds.values())
+        MySqlDB._write_behinds.clear()
+        await asyncio.gather(*[buffer.close() for buffer in buffers])
+
+
+def _copy_result(rc):
+    """copy of the result shared by the query cache / single flight, a caller changing its rows affects no other"""
+    if isinstance(rc, list):
+        # dict rows are copied, Row is a tuple of immutable values
+        return [dict(row) if isinstance(row, dict) else row for row in rc]
+    return copy.deepcopy(rc)
+
+
+async def _aiter(rows):
+    """iterate an iterable or an async iterable asynchronously"""
+    if hasattr(rows, '__aiter__'):
+        async for row in rows:
+            yield row
+    else:
+        for row in rows:
+            yield row
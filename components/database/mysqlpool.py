@@ -3,38 +3,58 @@
 
 import asyncio
 import collections
+import inspect
+import logging
 from multiprocessing.synchronize import Condition
 import warnings
 
 from aiomysql.connection import connect
+from components.utils.metrics import percentiles
 from aiomysql.utils import (_PoolContextManager, _PoolConnectionContextManager,
                     _PoolAcquireContextManager)
 
+_CONNECT_ARGS = set(inspect.signature(connect).parameters) - {'echo', 'loop'}
+
 
 def create_pool(minsize=1, maxsize=10, echo=False, pool_recycle=-1,
-                loop=None, **kwargs):
+                loop=None, idle_timeout=-1, reap_interval=10, acquire_timeout=None, share_db=False, **kwargs):
     coro = _create_pool(minsize=minsize, maxsize=maxsize, echo=echo,
-                        pool_recycle=pool_recycle, loop=loop, **kwargs)
+                        pool_recycle=pool_recycle, loop=loop,
+                        idle_timeout=idle_timeout, reap_interval=reap_interval,
+                        acquire_timeout=acquire_timeout, share_db=share_db, **kwargs)
     return _PoolContextManager(coro)
 
 
 async def _create_pool(minsize=1, maxsize=10, echo=False, pool_recycle=-1,
-                       loop=None, **kwargs):
+                       loop=None, idle_timeout=-1, reap_interval=10, acquire_timeout=None, share_db=False, **kwargs):
     if loop is None:
         loop = asyncio.get_event_loop()
 
     pool = Pool(minsize=minsize, maxsize=maxsize, echo=echo,
-                pool_recycle=pool_recycle, loop=loop, **kwargs)
-    # if minsize > 0:
-    #     async with pool.condition(**kwargs) as cond:
-    #         await pool._fill_free_pool(False, cond, **kwargs)
+                pool_recycle=pool_recycle, loop=loop,
+                idle_timeout=idle_timeout, reap_interval=reap_interval,
+                acquire_timeout=acquire_timeout, share_db=share_db, **kwargs)
+    # connections are opened on demand, call pool.prewarm(**kwargs) to open minsize connections at startup
     return pool
 
 
-class Pool(asyncio.AbstractServer):
-    """Connection pool"""
+class PoolExhaustedError(asyncio.TimeoutError):
+    """No free connection in the sub pool within the acquire timeout"""
+    pass
+
 
-    def __init__(self, minsize, maxsize, echo, pool_recycle, loop, **kwargs):
+class Pool(asyncio.AbstractServer):
+    """Connection pool, one sub pool per config key (host/port/db/user).
+    the health check / recycle / idle trimming of the free connections is done by a background
+    reaper task per config key every `reap_interval` seconds, acquire only pops a free connection.
+    `idle_timeout`: free connections beyond minsize unused for more than it (seconds) are closed, -1: never
+    `acquire_timeout`: default seconds to wait for a connection when the sub pool is full, None: forever
+    `share_db`: one sub pool per host/port/user, the connection is switched to the db asked on checkout (COM_INIT_DB)
+    the waiters of a sub pool are served in FIFO order, sub pools never wait for each other.
+    """
+
+    def __init__(self, minsize, maxsize, echo, pool_recycle, loop,
+                 idle_timeout=-1, reap_interval=10, acquire_timeout=None, share_db=False, **kwargs):
         if minsize < 0:
             raise ValueError("minsize should be zero or greater")
         if maxsize < minsize:
@@ -42,16 +62,26 @@ class Pool(asyncio.AbstractServer):
         self._minsize = minsize
         self._maxsize = maxsize
         self._loop = loop
+        # state per config key, all the access are in the event loop thread, no lock needed
         self._acquiring = {}
-        self._free = {} 
-        self._cond = asyncio.Condition()
-        self._config_cond = {}
+        self._free = {}
         self._used = {}
         self._terminated = {}
+        self._waiters = {}
+        self._released = asyncio.Event()
         self._closing = False
         self._closed = False
         self._echo = echo
         self._recycle = pool_recycle
+        self._idle_timeout = idle_timeout
+        self._reap_interval = reap_interval
+        self._acquire_timeout = acquire_timeout
+        self._share_db = share_db
+        self._key_fields = ('host', 'port', 'user') if share_db else ('host', 'port', 'db', 'user')
+        # config key -> connect kwargs / reaper task / statistics
+        self._connect_kwargs = {}
+        self._reapers = {}
+        self._stats = {}
 
     @property
     def echo(self):
@@ -70,23 +100,10 @@ class Pool(asyncio.AbstractServer):
 
     def config_key(self, conn = None, **_kwargs):
         if conn:
-            keys = ['' if not conn.host else f'host-{conn.host}', 
-                            '' if not conn.port else f'port-{conn.port}', 
-                            '' if not conn.db else f'db-{conn.db}', 
-                            '' if not conn.user else f'user-{conn.user}' ]
-
-            return ' '.join([item for item in keys if item])
-
-        return ' '.join ([ f'{k}-{v}' for k,v in _kwargs.items() if k in ('host', 'port', 'db','user')]) 
-
-    async def condition(self, key='', **_kwargs):
-        cond = None
-        async with self._cond:
-            key = self.config_key(**_kwargs) if not key else key
-            cond = self._config_cond.get(key, asyncio.Condition())
-            self._config_cond[key] = cond
-        return cond
-    
+            _kwargs = {'host': conn.host, 'port': conn.port, 'db': conn.db, 'user': conn.user}
+        # fixed order, the key of a connection must be the same as the key of its config
+        return ' '.join([f'{k}-{_kwargs[k]}' for k in self._key_fields if _kwargs.get(k)])
+
     def acquiring(self, key='', **_kwargs):
         return self._acquiring.get(self.config_key(**_kwargs) if not key else key, 0)
 
@@ -101,41 +118,68 @@ class Pool(asyncio.AbstractServer):
 
     def used(self, key='', **_kwargs):
         key = self.config_key(**_kwargs) if not key else key
-        self._used[key] = self._used.get(key, set())
-        return self._used[key]
+        used = self._used.get(key)
+        if used is None:
+            used = self._used[key] = set()
+        return used
 
     def free(self, key = '', **_kwargs):
         key = self.config_key(**_kwargs) if not key else key
-        self._free[key] = self._free.get(key, collections.deque(maxlen=self.maxsize))
-        return self._free[key]
+        free = self._free.get(key)
+        if free is None:
+            free = self._free[key] = collections.deque(maxlen=self.maxsize)
+        return free
 
     def terminated(self, key = '', **_kwargs):
         key = self.config_key(**_kwargs) if not key else key
-        self._terminated[key] = self._terminated.get(key, set())
-        return self._terminated[key]
+        terminated = self._terminated.get(key)
+        if terminated is None:
+            terminated = self._terminated[key] = set()
+        return terminated
+
+    def waiters(self, key = '', **_kwargs):
+        key = self.config_key(**_kwargs) if not key else key
+        waiters = self._waiters.get(key)
+        if waiters is None:
+            waiters = self._waiters[key] = collections.deque()
+        return waiters
+
+    def statistics(self, key):
+        stats = self._stats.get(key)
+        if stats is None:
+            stats = self._stats[key] = {
+                'created': 0, 'failed_connects': 0, 'recycled': 0, 'closed_idle': 0, 'closed_broken': 0,
+                'acquired': 0, 'acquire_timeouts': 0, 'db_switches': 0,
+                # acquire wait time (seconds) of the latest acquires
+                'acquire_waits': collections.deque(maxlen=1000)}
+        return stats
+
+    def stats(self):
+        """statistics per config key of the pool in current process"""
+        result = {}
+        for key in list(self._stats.keys()):
+            stats = dict(self._stats[key])
+            waits = stats.pop('acquire_waits')
+            result[key] = dict(
+                size=self.size(key), in_use=len(self.used(key)), idle=len(self.free(key)),
+                connecting=self.acquiring(key),
+                waiters=len([fut for fut in self.waiters(key) if not fut.done()]),
+                acquire_wait_ms={k: round(v * 1000, 3) for k, v in percentiles(waits).items()},
+                **stats)
+        return result
 
     def size(self, key='', **_kwargs):
         key = self.config_key(**_kwargs) if not key else key
         return len(self.free(key=key)) + len(self.used(key=key)) + self.acquiring(key=key)
 
-    async def clear(self):
-        """Close all free connections in all pools."""
-        async with self._cond:
-            for queue in self._free.values():
-                while queue:
-                    conn = queue.popleft()
-                    await conn.ensure_closed()
-            self._cond.notify()
-
     async def clear(self, key= '', **_kwargs):
-        """Close all free connections in spedified pool."""
-        _cond = self.condition(key=key, **_kwargs)
-        async with _cond:
-            queue = self.free(key=key, **_kwargs)
+        """Close all free connections in spedified pool, or in all pools if not specified."""
+        key = self.config_key(**_kwargs) if not key else key
+        queues = [self.free(key)] if key else list(self._free.values())
+        for queue in queues:
             while queue:
                 conn = queue.popleft()
                 await conn.ensure_closed()
-            _cond.notify()
 
     def close(self):
         """Close pool.
@@ -146,6 +190,14 @@ class Pool(asyncio.AbstractServer):
         if self._closed:
             return
         self._closing = True
+        for reaper in self._reapers.values():
+            reaper.cancel()
+        self._reapers.clear()
+        for waiters in self._waiters.values():
+            while waiters:
+                fut = waiters.popleft()
+                if not fut.done():
+                    fut.set_exception(RuntimeError("Cannot acquire connection after closing pool"))
 
     def terminate(self):
         """Terminate pool.
@@ -175,89 +227,205 @@ class Pool(asyncio.AbstractServer):
                 conn = queue.popleft()
                 conn.close()
 
-        for key in self._free.keys():
-            cond = await self.condition(key)
-            async with cond:
-                while self.size(key) > self.freesize(key):
-                    await cond.wait()
+        for key in list(self._free.keys()):
+            while self.size(key) > len(self.free(key)):
+                self._released.clear()
+                await self._released.wait()
 
         self._closed = True
 
-    def acquire(self, **kwargs):
-        """Acquire free connection from the pool."""
-        coro = self._acquire(**kwargs)
+    def acquire(self, acquire_timeout=None, **kwargs):
+        """Acquire free connection from the pool.
+        `acquire_timeout`: seconds, raise PoolExhaustedError if no connection available in time,
+        default: the acquire_timeout of the pool
+        """
+        coro = self._acquire(acquire_timeout=acquire_timeout, **kwargs)
         return _PoolAcquireContextManager(coro, self)
 
-    async def _acquire(self, **_kwargs):
+    async def _acquire(self, acquire_timeout=None, **_kwargs):
         if self._closing:
             raise RuntimeError("Cannot acquire connection after closing pool")
-        cond = await self.condition(**_kwargs)
-        async with cond:
-            while True:
-                await self._fill_free_pool(True, cond=cond, **_kwargs)
-                free = self.free(**_kwargs)
-                if free:
-                    conn = free.popleft()
-                    assert not conn.closed, conn
-                    used = self.used(**_kwargs)
-                    assert conn not in used, (conn, used)
-                    used.add(conn)
-                    return conn
-                else:
-                    await cond.wait()
-
-    async def _fill_free_pool(self, override_min, cond, **_kwargs):
-        # iterate over free connections and remove timeouted ones
-        free = self.free(**_kwargs)
-        free_size = len(free)
-        n = 0
-
-        # 清理到指定数据库的连接
-        while n < free_size:
-            conn = free[-1]
-
-            if conn._reader.at_eof() or conn._reader.exception():
-                free.pop()
-                conn.close()
-
-            elif (self._recycle > -1 and
-                  self._loop.time() - conn.last_usage > self._recycle):
-                free.pop()
+        key = self.config_key(**_kwargs)
+        self._ensure_reaper(key, _kwargs)
+        waiters = self.waiters(key)
+        timeout = self._acquire_timeout if acquire_timeout is None else acquire_timeout
+        stats, start_point = self.statistics(key), self._loop.time()
+        conn = await self._acquire_conn(key, waiters, timeout)
+        if self._share_db:
+            try:
+                await self.select_db(conn, _kwargs.get('db'))
+            except Exception:
+                self.release(conn)
+                raise
+            except BaseException:
+                # cancelled in the middle of the command, the connection can not be reused
                 conn.close()
+                self.release(conn)
+                raise
+        stats['acquired'] += 1
+        stats['acquire_waits'].append(self._loop.time() - start_point)
+        return conn
+
+    async def select_db(self, conn, db):
+        """switch the connection to `db`, skipped if it is the current db of the connection"""
+        if not db or conn.db == db:
+            return
+        await conn.select_db(db)
+        # aiomysql does not track it
+        conn._db = db
+        self.statistics(self.config_key(conn=conn))['db_switches'] += 1
+
+    async def _acquire_conn(self, key, waiters, timeout):
+        # FIFO: a new comer never takes a connection while others are waiting
+        slot_handed = False
+        while True:
+            if slot_handed or not waiters:
+                conn = self._pop_free(key)
+                if conn:
+                    return conn
+                if self.size(key) < self.maxsize:
+                    try:
+                        conn = await self._connect(key)
+                    except BaseException:
+                        # let the next waiter try
+                        self._hand_over(key, None)
+                        raise
+                    self.used(key).add(conn)
+                    return conn
 
-            else:
-                free.rotate()
- 
-            n += 1
-
-        # make sure the current config has meet the minsize
-        while self.size(**_kwargs) < self.minsize:
-            self.add_acquiring()
+            fut = self._loop.create_future()
+            waiters.append(fut)
             try:
-                conn = await connect(echo=self._echo, loop=self._loop,
-                                     **_kwargs)
-                # raise exception if pool is closing
-                free.append(conn)
-                cond.notify()
-            finally:
-                self.release_acquiring()
-        if free:
+                conn = await asyncio.wait_for(asyncio.shield(fut), timeout)
+            except BaseException as e:
+                if fut.done() and not fut.cancelled() and fut.exception() is None:
+                    # handed over at the same moment, pass it to the next one
+                    self._hand_over(key, fut.result(), from_used=True)
+                else:
+                    fut.cancel()
+                    if fut in waiters:
+                        waiters.remove(fut)
+                if isinstance(e, asyncio.TimeoutError):
+                    self.statistics(key)['acquire_timeouts'] += 1
+                    raise PoolExhaustedError("mysql pool [%s] exhausted: no free connection in %ss, size:%d waiters:%d"
+                                             % (key, timeout, self.size(key), len(waiters))) from None
+                raise
+            if conn:
+                return conn
+            # a slot is freed (connection closed), connect by myself
+            slot_handed = True
+
+    def _pop_free(self, key):
+        free = self.free(key)
+        while free:
+            # LIFO: the most recently used connection, the idle ones at left are trimmed by reaper
+            conn = free.pop()
+            if not self._is_alive(conn):
+                self._close(key, conn)
+                continue
+            used = self.used(key)
+            assert conn not in used, (conn, used)
+            used.add(conn)
+            return conn
+        return None
+
+    def _hand_over(self, key, conn, from_used=False):
+        """give the released connection to the first waiter, None: tell the waiter a slot is freed"""
+        waiters = self._waiters.get(key)
+        while waiters:
+            fut = waiters.popleft()
+            if fut.done():
+                # timeout / cancelled
+                continue
+            if conn and not from_used:
+                self.used(key).add(conn)
+            fut.set_result(conn)
             return
-
-        if override_min and self.size(**_kwargs) < self.maxsize:
-            self.add_acquiring()
+        if conn:
+            if from_used:
+                self.used(key).discard(conn)
+            self.free(key).append(conn)
+
+    def _is_alive(self, conn):
+        return self._close_reason(conn) is None
+
+    def _close_reason(self, conn):
+        if conn.closed or conn._reader.at_eof() or conn._reader.exception():
+            return 'closed_broken'
+        if self._recycle > -1 and self._loop.time() - conn.last_usage > self._recycle:
+            return 'recycled'
+        return None
+
+    def _close(self, key, conn, reason=None):
+        self.statistics(key)[reason or self._close_reason(conn) or 'closed_broken'] += 1
+        conn.close()
+
+    async def _connect(self, key):
+        self.add_acquiring(key)
+        try:
+            conn = await connect(echo=self._echo, loop=self._loop,
+                                 **self._connect_kwargs[key])
+            self.statistics(key)['created'] += 1
+            return conn
+        except Exception:
+            self.statistics(key)['failed_connects'] += 1
+            raise
+        finally:
+            self.release_acquiring(key)
+
+    def _ensure_reaper(self, key, _kwargs):
+        if key in self._reapers:
+            return
+        # the config has the settings of pool / MySqlDB too, only pass the arguments of connect()
+        self._connect_kwargs[key] = {k: v for k, v in _kwargs.items() if k in _CONNECT_ARGS}
+        if self._reap_interval > 0:
+            self._reapers[key] = self._loop.create_task(self._reaper(key))
+
+    async def _reaper(self, key):
+        while not self._closing:
+            await asyncio.sleep(self._reap_interval)
             try:
-                conn = await connect(echo=self._echo, loop=self._loop,
-                                     **_kwargs)
-                # raise exception if pool is closing
-                free.append(conn)
-                cond.notify()
-            finally:
-                self.release_acquiring()
-
-    async def _wakeup(self):
-        async with self._cond:
-            self._cond.notify()
+                await self._reap(key)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.getLogger().warning('mysql pool reaper [%s] error: %s' % (key, e))
+
+    async def _reap(self, key):
+        """close the broken / recycled / idle free connections, then fill up to minsize"""
+        free = self.free(key)
+        now = self._loop.time()
+        keep = collections.deque(maxlen=free.maxlen)
+        # from the least recently used
+        while free:
+            conn = free.popleft()
+            if not self._is_alive(conn):
+                self._close(key, conn)
+            elif (self._idle_timeout > -1 and now - conn.last_usage > self._idle_timeout and
+                    self.size(key) + len(keep) >= self.minsize):
+                self._close(key, conn, 'closed_idle')
+            else:
+                keep.append(conn)
+        free.extend(keep)
+
+        while self.size(key) < self.minsize and not self._closing:
+            self._hand_over(key, await self._connect(key))
+
+    async def prewarm(self, count=None, **_kwargs):
+        """open `count` (default minsize) connections of the config in parallel,
+        return the number of connections opened, raise the first error if none opened
+        """
+        key = self.config_key(**_kwargs)
+        self._ensure_reaper(key, _kwargs)
+        count = self.minsize if count is None else count
+        results = await asyncio.gather(*[self._connect(key) for _ in range(count - self.size(key))],
+                                       return_exceptions=True)
+        conns = [conn for conn in results if not isinstance(conn, BaseException)]
+        for conn in conns:
+            self._hand_over(key, conn)
+        if len(conns) < len(results) and not conns:
+            raise next(conn for conn in results if isinstance(conn, BaseException))
+        return len(conns)
 
     def release(self, conn):
         """Release free connection back to the connection pool.
@@ -266,6 +434,7 @@ class Pool(asyncio.AbstractServer):
         """
         fut = self._loop.create_future()
         fut.set_result(None)
+        self._released.set()
 
         terminated = self.terminated(key=self.config_key(conn=conn))
         if conn in terminated:
@@ -273,20 +442,17 @@ class Pool(asyncio.AbstractServer):
             terminated.remove(conn)
             return fut
 
-        used = self.used(key=self.config_key(conn=conn))
+        key = self.config_key(conn=conn)
+        used = self.used(key=key)
         assert used, (conn, self._used)
         used.remove(conn)
 
         if not conn.closed:
             in_trans = conn.get_transaction_status()
-            if in_trans:
+            if in_trans or self._closing:
                 conn.close()
-                return fut
-            if self._closing:
-                conn.close()
-            else:
-                self.free(self.config_key(conn)).append(conn)
-            fut = self._loop.create_task(self._wakeup())
+        # either a free connection or a free slot for the first waiter
+        self._hand_over(key, None if conn.closed else conn)
         return fut
 
     def get(self):
@@ -0,0 +1,109 @@
+import re
+from collections import defaultdict
+
+from components.utils.lrucache import LRUCache
+
+# tables a statement reads or writes: from / join / into / update / table / truncate, with optional `db`.
+# a comma separated list (from a x, b y / update a, b) is captured whole, with the aliases but the last
+_TABLE = r'(?:`?\w+`?\.)?`?\w+`?'
+_TABLE_RE = re.compile(r'\b(?:from|join|into|update|table|truncate)\s+(?:table\s+)?(?:if\s+(?:not\s+)?exists\s+)?'
+                       r'(%s(?:(?:\s+(?:as\s+)?\w+)?\s*,\s*%s)*)' % (_TABLE, _TABLE),
+                       re.IGNORECASE)
+
+# string literals / quoted names, kept as is by normalize_sql
+_LITERAL_RE = re.compile(r"'(?:[^'\\]|\\.|'')*'|\"(?:[^\"\\]|\\.|\"\")*\"|`[^`]*`", re.DOTALL)
+
+_SPACES_RE = re.compile(r'\s+')
+
+# selects whose result depends on the session or the time, never cached / shared
+_SESSION_RE = re.compile(r'@|\b(?:last_insert_id|found_rows|row_count|connection_id|now|sysdate|curdate|curtime|'
+                         r'utc_date|utc_time|utc_timestamp|unix_timestamp|rand|uuid|uuid_short|user|current_user|'
+                         r'session_user|system_user|database|schema|get_lock|release_lock|is_free_lock|is_used_lock|'
+                         r'sleep|benchmark)\s*\(|\b(?:current_date|current_time|current_timestamp|localtime|'
+                         r'localtimestamp)\b|\bfor\s+update\b|\block\s+in\s+share\s+mode\b|\bfor\s+share\b',
+                         re.IGNORECASE)
+
+
+def tables_of(sql):
+    """lower case table names (without db) referenced by the sql"""
+    return {item.split()[0].replace('`', '').split('.')[-1].lower()
+            for names in _TABLE_RE.findall(sql) for item in names.split(',')}
+
+
+def normalize_sql(sql):
+    """whitespace collapsed, except in string literals"""
+    parts, end = [], 0
+    for match in _LITERAL_RE.finditer(sql):
+        parts.append(_SPACES_RE.sub(' ', sql[end:match.start()]))
+        parts.append(match.group())
+        end = match.end()
+    parts.append(_SPACES_RE.sub(' ', sql[end:]))
+    return ''.join(parts).strip()
+
+
+def session_dependent(sql):
+    """the result depends on the connection / time: LAST_INSERT_ID(), NOW(), @var, FOR UPDATE..."""
+    return bool(_SESSION_RE.search(sql))
+
+
+class QueryCache():
+    """Result cache of select statements, LRU bounded by memory size with ttl.
+    writes invalidate the entries of the tables they touch (in current process only).
+    each invalidation increases the generation of the tables, a select started before it is not stored:
+        generation = cache.generation(key); rows = <select>; cache.set(key, rows, generation=generation)
+    """
+
+    def __init__(self, max_size, ttl=60) -> None:
+        self._cache = LRUCache(max_size, ttl, on_evict=self._forget)
+        # table -> cache keys
+        self._tables = defaultdict(set)
+        # table -> times invalidated
+        self._generations = defaultdict(int)
+        self.invalidations = 0
+
+    def key(self, target, sql, params=None):
+        return (target, normalize_sql(sql), repr(params))
+
+    def get(self, key):
+        return self._cache.get(key)
+
+    def generation(self, key):
+        """generation of the tables of the key, taken before executing the select"""
+        return tuple(self._generations.get(table, 0) for table in sorted(tables_of(key[1])))
+
+    def set(self, key, rows, ttl=None, generation=None):
+        """`generation`: see generation(), the rows are dropped if a table was invalidated since"""
+        if generation is not None and generation != self.generation(key):
+            return
+        if self._cache.set(key, rows, ttl):
+            for table in tables_of(key[1]):
+                self._tables[table].add(key)
+
+    def invalidate(self, sql):
+        """drop the entries of the tables written by `sql`"""
+        self.invalidate_tables(tables_of(sql))
+
+    def invalidate_tables(self, tables):
+        """drop the entries of the tables, names as in sql: table / `db`.`table`"""
+        for table in tables:
+            table = table.replace('`', '').split('.')[-1].lower()
+            self._generations[table] += 1
+            for key in self._tables.pop(table, ()):
+                if self._cache.pop(key) is not None:
+                    self.invalidations += 1
+                    self._forget(key)
+
+    def clear(self):
+        self._cache.clear()
+        self._tables.clear()
+
+    def _forget(self, key):
+        for table in tables_of(key[1]):
+            keys = self._tables.get(table)
+            if keys:
+                keys.discard(key)
+                if not keys:
+                    del self._tables[table]
+
+    def stats(self):
+        return dict(self._cache.stats(), invalidations=self.invalidations)
@@ -0,0 +1,115 @@
+"""Compact result sets of exec_select, the column names are kept once instead of in every row.
+
+`rows` mode: list of Row, a tuple can be read like the dict rows: row['col'], row.get('col'), dict(row)
+`columns` mode: ColumnarResult, one array per column, numeric columns in array('q') / array('d')
+or numpy arrays if numpy is installed and asked for.
+"""
+from array import array
+
+from components.utils.lrucache import estimate_size
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+class Row(tuple):
+    """tuple row sharing the column index of its result set"""
+    __slots__ = ()
+    _index = {}
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            return tuple.__getitem__(self, self._index[key])
+        return tuple.__getitem__(self, key)
+
+    def __contains__(self, key):
+        return key in self._index
+
+    def get(self, key, default=None):
+        index = self._index.get(key)
+        return default if index is None else tuple.__getitem__(self, index)
+
+    def keys(self):
+        return self._index.keys()
+
+    def values(self):
+        return tuple(self)
+
+    def items(self):
+        return zip(self._index.keys(), self)
+
+    def to_dict(self):
+        return dict(zip(self._index.keys(), self))
+
+
+_row_classes = {}
+
+
+def row_class(columns):
+    """Row subclass of the columns, the rows of one result set share the index"""
+    columns = tuple(columns)
+    cls = _row_classes.get(columns)
+    if cls is None:
+        if len(_row_classes) > 1000:
+            _row_classes.clear()
+        cls = _row_classes[columns] = type('Row', (Row,), {
+            '__slots__': (), '_index': {column: i for i, column in enumerate(columns)}})
+    return cls
+
+
+def _column_array(values, use_numpy):
+    kinds = {type(value) for value in values}
+    if kinds and kinds <= {int}:
+        if use_numpy and numpy:
+            return numpy.array(values, dtype=numpy.int64)
+        try:
+            return array('q', values)
+        except OverflowError:
+            return values
+    if kinds and kinds <= {int, float}:
+        if use_numpy and numpy:
+            return numpy.array(values, dtype=numpy.float64)
+        return array('d', values)
+    return values
+
+
+class ColumnarResult():
+    """column names + one array per column"""
+
+    def __init__(self, columns, rows, use_numpy=False) -> None:
+        self.columns = list(columns)
+        self.length = len(rows)
+        self.data = {column: _column_array([row[i] for row in rows], use_numpy)
+                     for i, column in enumerate(self.columns)}
+
+    def __len__(self):
+        return self.length
+
+    def __sizeof__(self):
+        # the column arrays, the query cache sizes its entries by sys.getsizeof()
+        return object.__sizeof__(self) + estimate_size(self.columns) + estimate_size(self.data)
+
+    def __getitem__(self, column):
+        return self.data[column]
+
+    def rows(self):
+        """iterate the rows as Row"""
+        cls = row_class(self.columns)
+        arrays = [self.data[column] for column in self.columns]
+        for i in range(self.length):
+            yield cls(values[i] for values in arrays)
+
+    def to_dicts(self):
+        return [row.to_dict() for row in self.rows()]
+
+
+def make_result(columns, rows, result_mode, use_numpy=False):
+    """convert the tuple rows fetched into `result_mode`: rows / columns"""
+    if result_mode == 'rows':
+        cls = row_class(columns)
+        return [cls(row) for row in rows]
+    if result_mode == 'columns':
+        return ColumnarResult(columns, rows, use_numpy)
+    raise ValueError('unknown result_mode %s' % result_mode)
@@ -0,0 +1,119 @@
+"""Sharded MySqlDB: statements are routed by a shard key to one of several mysql configs by consistent hashing.
+
+adding / removing a shard only moves the keys of about 1/N of the ring, the other keys stay on their shard.
+each shard is a MySqlDB of its own config, so it has its own pool key (and connections) in mysqlpool.Pool.
+"""
+import asyncio
+import bisect
+import hashlib
+
+from components.database.mysqldb import MySqlDB
+
+
+def _hash(value):
+    return int.from_bytes(hashlib.md5(str(value).encode('utf-8')).digest()[:8], 'big')
+
+
+class HashRing():
+    """consistent hash ring of the node names, `vnodes` points per node"""
+
+    def __init__(self, nodes, vnodes=160) -> None:
+        points = sorted((_hash('%s#%d' % (node, i)), node) for node in nodes for i in range(vnodes))
+        self._hashes = [point for point, _ in points]
+        self._nodes = [node for _, node in points]
+
+    def node(self, key):
+        if not self._nodes:
+            raise ValueError('no node in the hash ring')
+        index = bisect.bisect(self._hashes, _hash(key))
+        return self._nodes[index % len(self._nodes)]
+
+
+# (shard names, vnodes) -> HashRing, built once per process
+_rings = {}
+
+
+class ShardedMySqlDB():
+    """`shards`: shard name -> mysql config, the name is hashed, renaming a shard moves its keys.
+    exec_select / exec_sql / ... run on the shard of `shard_key`, *_all run on every shard concurrently.
+    transactions can not span shards.
+    """
+
+    def __init__(self, shards, vnodes=160) -> None:
+        if not shards:
+            raise ValueError('no shard configured')
+        self._dbs = {name: MySqlDB(dict(config)) for name, config in shards.items()}
+        key = (tuple(sorted(self._dbs.keys())), vnodes)
+        self._ring = _rings.get(key)
+        if self._ring is None:
+            self._ring = _rings[key] = HashRing(key[0], vnodes)
+
+    @property
+    def shards(self):
+        return self._dbs
+
+    def shard_of(self, shard_key):
+        """name of the shard `shard_key` belongs to"""
+        return self._ring.node(shard_key)
+
+    def shard(self, shard_key):
+        """MySqlDB of the shard `shard_key` belongs to"""
+        return self._dbs[self._ring.node(shard_key)]
+
+    async def exec_select(self, sql, shard_key, *args, **kwargs):
+        return await self.shard(shard_key).exec_select(sql, *args, **kwargs)
+
+    async def exec_sql(self, sql, shard_key, *args, **kwargs):
+        return await self.shard(shard_key).exec_sql(sql, *args, **kwargs)
+
+    async def exec_multi(self, sql, shard_key, *args, **kwargs):
+        return await self.shard(shard_key).exec_multi(sql, *args, **kwargs)
+
+    async def executemany(self, sql, shard_key, *args, **kwargs):
+        return await self.shard(shard_key).executemany(sql, *args, **kwargs)
+
+    async def bulk_insert(self, table, rows, shard_key_col, **kwargs):
+        """insert the dict rows into the shards of row[shard_key_col], the shards are written concurrently"""
+        groups = {}
+        for row in rows:
+            groups.setdefault(self.shard_of(row[shard_key_col]), []).append(row)
+        results = await asyncio.gather(*[self._dbs[name].bulk_insert(table, group, **kwargs)
+                                         for name, group in groups.items()])
+        return dict(zip(groups.keys(), results))
+
+    async def fan_out(self, method, *args, **kwargs):
+        """call MySqlDB.`method` on every shard concurrently, return {shard name: result},
+        the first error is raised after all the shards finished
+        """
+        names = list(self._dbs.keys())
+        results = await asyncio.gather(*[getattr(self._dbs[name], method)(*args, **kwargs) for name in names],
+                                       return_exceptions=True)
+        for result in results:
+            if isinstance(result, BaseException):
+                raise result
+        return dict(zip(names, results))
+
+    async def exec_select_all(self, sql, params=None, order_by=None, reverse=False, limit=None, **kwargs):
+        """run the select on every shard concurrently and merge the rows,
+        `order_by`: column (or key function) to sort the merged rows, `limit`: max rows returned
+        the statement should have its own order by / limit so each shard returns only the candidates
+        """
+        results = await self.fan_out('exec_select', sql, params=params, **kwargs)
+        rows = [row for result in results.values() for row in result]
+        if order_by:
+            rows.sort(key=order_by if callable(order_by) else (lambda row: row[order_by]), reverse=reverse)
+        return rows[:limit] if limit else rows
+
+    async def exec_sql_all(self, sql, params=None, commit=False):
+        """run the statement on every shard concurrently (ddl, maintenance...)"""
+        await self.fan_out('exec_sql', sql, params=params, commit=commit)
+
+    def release(self):
+        for db in self._dbs.values():
+            db.release()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        self.release()
@@ -0,0 +1,113 @@
+"""Statistics of the statements executed by MySqlDB, aggregated per fingerprint (literals stripped),
+and the slow query log.
+
+`sql_stats` keeps the statistics of current process, see /admin/sql_stats.
+statements slower than `slow_query_time` (seconds, in mysql config) are logged by the `slow_query` logger.
+"""
+import logging
+import re
+import time
+from collections import OrderedDict, deque
+
+from components.utils.metrics import percentiles
+
+slow_log = logging.getLogger('slow_query')
+
+_COMMENT_RE = re.compile(r'/\*.*?\*/|(?:--|#)[^\n]*', re.DOTALL)
+_STRING_RE = re.compile(r"'(?:[^'\\]|\\.|'')*'|\"(?:[^\"\\]|\\.|\"\")*\"")
+_NUMBER_RE = re.compile(r'(?<![\w.])-?(?:0x[0-9a-f]+|\d+(?:\.\d+)?(?:e[+-]?\d+)?)\b', re.IGNORECASE)
+_PLACEHOLDER_RE = re.compile(r'%\(\w+\)s|%s|\?')
+_LIST_RE = re.compile(r'\(\s*\?(?:\s*,\s*\?)*\s*\)')
+_VALUES_RE = re.compile(r'\(\?\+\)(?:\s*,\s*\(\?\+\))+')
+
+
+def fingerprint(sql):
+    """statement with literals / placeholders replaced by ?, lists by (?+), in lower case:
+    select * from t where id in (1, 2, 3) and name = 'x' -> select * from t where id in (?+) and name = ?
+    """
+    sql = _COMMENT_RE.sub(' ', sql)
+    sql = _STRING_RE.sub('?', sql)
+    sql = _NUMBER_RE.sub('?', sql)
+    sql = _PLACEHOLDER_RE.sub('?', sql)
+    sql = _LIST_RE.sub('(?+)', sql)
+    sql = _VALUES_RE.sub('(?+)', sql)
+    return ' '.join(sql.split()).lower()
+
+
+class SqlStats():
+    """count / time / rows per fingerprint, the latest `samples` times are kept for the percentiles"""
+
+    def __init__(self, max_fingerprints=1000, samples=1000) -> None:
+        self.max_fingerprints = max_fingerprints
+        self.samples = samples
+        self.since = time.time()
+        self._stats = OrderedDict()
+        # raw sql -> fingerprint, the same statements are executed again and again
+        self._fingerprints = {}
+
+    def fingerprint(self, sql):
+        result = self._fingerprints.get(sql)
+        if result is None:
+            result = fingerprint(sql)
+            # long statements (bulk inserts) are rarely the same, do not keep them
+            if len(sql) <= 4096:
+                if len(self._fingerprints) >= 10000:
+                    self._fingerprints.clear()
+                self._fingerprints[sql] = result
+        return result
+
+    def record(self, sql, execute_time, fetch_time=0, rows=0, error=False, slow_time=None, acquire_time=0):
+        """add one execution of `sql`, log it into the slow query log if it takes `slow_time` seconds or more,
+        `acquire_time`: seconds waited for the connection (pool wait / connect), not part of the execute time
+        """
+        key = self.fingerprint(sql)
+        stats = self._stats.get(key)
+        if stats is None:
+            if len(self._stats) >= self.max_fingerprints:
+                # forget the fingerprint not executed for the longest time
+                self._stats.popitem(last=False)
+            stats = self._stats[key] = {
+                'count': 0, 'errors': 0, 'slow': 0, 'acquire_time': 0.0, 'execute_time': 0.0, 'fetch_time': 0.0,
+                'rows': 0, 'max_rows': 0, 'execute_times': deque(maxlen=self.samples),
+                'fetch_times': deque(maxlen=self.samples), 'example': sql[:2000]}
+        else:
+            self._stats.move_to_end(key)
+        stats['count'] += 1
+        stats['errors'] += 1 if error else 0
+        stats['acquire_time'] += acquire_time
+        stats['execute_time'] += execute_time
+        stats['fetch_time'] += fetch_time
+        stats['rows'] += rows
+        stats['max_rows'] = max(stats['max_rows'], rows)
+        stats['execute_times'].append(execute_time)
+        stats['fetch_times'].append(fetch_time)
+
+        if slow_time and execute_time + fetch_time >= slow_time:
+            stats['slow'] += 1
+            slow_log.warning('%.3fs execute:%.3fs fetch:%.3fs acquire:%.3fs rows:%d%s\t%s' % (
+                execute_time + fetch_time, execute_time, fetch_time, acquire_time, rows, ' ERROR' if error else '', sql))
+
+    def stats(self, order='total_time', top=50):
+        """statistics of the `top` fingerprints sorted by `order`: total_time / count / p99 / slow / rows"""
+        result = []
+        for key, stats in self._stats.items():
+            item = {k: v for k, v in stats.items() if k not in ('execute_times', 'fetch_times')}
+            item['fingerprint'] = key
+            item['total_time'] = round(stats['execute_time'] + stats['fetch_time'], 6)
+            item['acquire_time'] = round(stats['acquire_time'], 6)
+            item['execute_time'] = round(stats['execute_time'], 6)
+            item['fetch_time'] = round(stats['fetch_time'], 6)
+            item['avg_rows'] = round(stats['rows'] / stats['count'], 1)
+            item['execute_ms'] = {k: round(v * 1000, 3) for k, v in percentiles(stats['execute_times']).items()}
+            item['fetch_ms'] = {k: round(v * 1000, 3) for k, v in percentiles(stats['fetch_times']).items()}
+            item['p99'] = item['execute_ms'].get('p99', 0) + item['fetch_ms'].get('p99', 0)
+            result.append(item)
+        result.sort(key=lambda item: item.get(order, 0), reverse=True)
+        return {'since': self.since, 'fingerprints': len(self._stats), 'statements': result[:top]}
+
+    def reset(self):
+        self.since = time.time()
+        self._stats.clear()
+
+
+sql_stats = SqlStats()
@@ -0,0 +1,149 @@
+"""Write behind buffer: rows queued per table and inserted later by multi-row INSERT statements.
+
+a flusher task per table writes a batch when `batch_size` rows are queued or the oldest row has waited
+`max_latency` seconds. at most `max_rows` rows are queued per table, put() waits for the flusher when full.
+the rows queued are lost if the process is killed, call close() at shutdown (see IPAApplication.shutdown).
+"""
+import asyncio
+import logging
+from collections import deque
+
+from components.utils.metrics import metrics
+
+log = logging.getLogger(__name__)
+
+
+class _TableBuffer():
+
+    def __init__(self) -> None:
+        self.rows = deque()
+        self.first_at = 0
+        # set when rows are queued or closing, wakes the flusher
+        self.wake = asyncio.Event()
+        self.not_full = asyncio.Event()
+        self.not_full.set()
+        # set when all the rows queued are written
+        self.flushed = asyncio.Event()
+        self.flushed.set()
+        self.flusher = None
+
+
+class WriteBehind():
+    """`db_factory`: callable returns a MySqlDB to insert the batches
+    `upsert`: insert with ON DUPLICATE KEY UPDATE of all the columns
+    `retry`: times a failed batch is retried (1s, 2s, 4s... later), then it is dropped and logged
+    """
+
+    def __init__(self, db_factory, batch_size=500, max_latency=1.0, max_rows=50000, upsert=False, retry=3) -> None:
+        self.db_factory = db_factory
+        self.batch_size = batch_size
+        self.max_latency = max_latency
+        self.max_rows = max(max_rows, batch_size)
+        self.upsert = upsert
+        self.retry = retry
+        self._buffers = {}
+        self._max_packet = None
+        self._closing = False
+
+    def queued(self, table=None):
+        """rows waiting to be inserted"""
+        if table:
+            return len(self._buffers[table].rows) if table in self._buffers else 0
+        return sum(len(buffer.rows) for buffer in self._buffers.values())
+
+    async def put(self, table, row, block=True):
+        """queue the dict `row` to be inserted into `table`,
+        wait while `max_rows` rows of the table are queued, raise asyncio.QueueFull instead if not `block`
+        """
+        if self._closing:
+            raise RuntimeError('write behind buffer is closed')
+        buffer = self._buffers.get(table)
+        if buffer is None:
+            buffer = self._buffers[table] = _TableBuffer()
+            buffer.flusher = asyncio.ensure_future(self._flusher(table, buffer))
+        while len(buffer.rows) >= self.max_rows:
+            if not block:
+                raise asyncio.QueueFull('%d rows of %s waiting to be inserted' % (len(buffer.rows), table))
+            buffer.not_full.clear()
+            await buffer.not_full.wait()
+            if self._closing:
+                raise RuntimeError('write behind buffer is closed')
+        if not buffer.rows:
+            buffer.first_at = asyncio.get_event_loop().time()
+            buffer.wake.set()
+        buffer.rows.append(row)
+        buffer.flushed.clear()
+        if len(buffer.rows) >= self.batch_size:
+            buffer.wake.set()
+        if len(buffer.rows) >= self.max_rows:
+            buffer.not_full.clear()
+
+    async def _flusher(self, table, buffer):
+        loop = asyncio.get_event_loop()
+        while True:
+            buffer.wake.clear()
+            if not buffer.rows:
+                if self._closing:
+                    return
+                await buffer.wake.wait()
+                continue
+            delay = buffer.first_at + self.max_latency - loop.time()
+            if len(buffer.rows) < self.batch_size and delay > 0 and not self._closing:
+                try:
+                    await asyncio.wait_for(buffer.wake.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            batch = [buffer.rows.popleft() for _ in range(min(self.batch_size, len(buffer.rows)))]
+            if len(buffer.rows) < self.max_rows:
+                buffer.not_full.set()
+            await self._write(table, batch)
+            if not buffer.rows:
+                buffer.flushed.set()
+
+    async def _write(self, table, rows):
+        # rows with the same columns go into one statement, a missing column gets its default value
+        groups = {}
+        for row in rows:
+            groups.setdefault(tuple(row.keys()), []).append(row)
+        for cols, group in groups.items():
+            for attempt in range(self.retry + 1):
+                try:
+                    async with self.db_factory() as db:
+                        if self._max_packet is None:
+                            self._max_packet = int(await db.max_allowed_packet() * 0.9)
+                        await db.bulk_insert(table, group, list(cols), upsert=self.upsert, max_packet=self._max_packet)
+                    metrics.inc('write_behind_rows_total', len(group), table=table, result='ok')
+                    break
+                except Exception as e:
+                    if attempt < self.retry and not self._closing:
+                        log.warning('write behind insert %d rows into %s failed, retry in %ds: %s'
+                                    % (len(group), table, 2 ** attempt, e))
+                        await asyncio.sleep(2 ** attempt)
+                        continue
+                    log.error('write behind insert %d rows into %s failed, dropped: %s' % (len(group), table, e))
+                    metrics.inc('write_behind_rows_total', len(group), table=table, result='dropped')
+                    break
+
+    async def flush(self, table=None):
+        """wait until the rows queued now are inserted"""
+        for name, buffer in list(self._buffers.items()):
+            if (table and name != table) or buffer.flusher.done():
+                continue
+            # make the flusher write without waiting for max_latency
+            buffer.first_at = 0
+            buffer.wake.set()
+            await buffer.flushed.wait()
+
+    async def close(self):
+        """stop accepting rows and insert all the rows queued"""
+        self._closing = True
+        for buffer in self._buffers.values():
+            buffer.wake.set()
+            buffer.not_full.set()
+        flushers = [buffer.flusher for buffer in self._buffers.values()]
+        if flushers:
+            await asyncio.gather(*flushers, return_exceptions=True)
+        queued = self.queued()
+        if queued:
+            log.error('write behind closed with %d rows not inserted' % queued)
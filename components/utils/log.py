@@ -1,3 +1,9 @@
+import logging
+import logging.handlers
+import os
+import queue
+import threading
+
 
 class ExtraLog():
     def __init__(self, handler, logger) -> None:
@@ -46,4 +52,122 @@ class ExtraLog():
 
     def log(self, level, msg):
         self.logger.log(level, msg, extra=self.extra)
-        return
\ No newline at end of file
+        return
+
+class AsyncLogHandler(logging.Handler):
+    """Put the records into a bounded queue, a background thread formats and writes them
+    into the wrapped handlers in batches, so a slow (network) file system never blocks the IOLoop.
+    `policy`: drop - drop the record when the queue is full, block - wait until the queue has space
+    """
+
+    def __init__(self, handlers, queue_size=10000, policy='drop', batch_size=200) -> None:
+        super().__init__()
+        self.handlers = handlers
+        self.queue_size = queue_size
+        self.policy = policy
+        self.batch_size = batch_size
+        self.dropped = 0
+        self._queue = None
+        self._thread = None
+        self._pid = None
+        return
+
+    def _start(self):
+        # threads do not survive fork(), every process starts its own writer
+        self._pid = os.getpid()
+        self._queue = queue.Queue(maxsize=self.queue_size)
+        self._thread = threading.Thread(target=self._run, name='AsyncLogHandler', daemon=True)
+        self._thread.start()
+
+    def prepare(self, record):
+        # merge args in the caller thread, args may be changed after the call returns
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def emit(self, record) -> None:
+        if self._pid != os.getpid():
+            self._start()
+        try:
+            record = self.prepare(record)
+            if self.policy == 'block':
+                self._queue.put(record)
+            else:
+                self._queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+        except Exception:
+            self.handleError(record)
+        return
+
+    def _run(self):
+        _queue = self._queue
+        reported = 0
+        while True:
+            batch = [_queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(_queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            stop = None in batch
+            records = [record for record in batch if record is not None]
+            if self.dropped > reported:
+                records.append(logging.makeLogRecord({
+                    'name': __name__, 'levelno': logging.WARNING, 'levelname': 'WARNING',
+                    'msg': 'AsyncLogHandler: %d log records dropped, the queue is full' % (self.dropped - reported)}))
+                reported = self.dropped
+
+            for handler in self.handlers:
+                self._write_batch(handler, records)
+            for _ in batch:
+                _queue.task_done()
+            if stop:
+                return
+
+    def _write_batch(self, handler, records):
+        records = [record for record in records if record.levelno >= handler.level and handler.filter(record)]
+        if not records:
+            return
+        if not isinstance(handler, logging.StreamHandler):
+            [handler.handle(record) for record in records]
+            return
+
+        # one write + one flush for the whole batch
+        handler.acquire()
+        try:
+            if isinstance(handler, logging.handlers.BaseRotatingHandler) and handler.shouldRollover(records[0]):
+                handler.doRollover()
+            if handler.stream is None and isinstance(handler, logging.FileHandler):
+                handler.stream = handler._open()
+            handler.stream.write(''.join([handler.format(record) + handler.terminator for record in records]))
+            handler.flush()
+        except Exception:
+            handler.handleError(records[0])
+        finally:
+            handler.release()
+
+    def flush(self) -> None:
+        """wait until the queued records are written"""
+        if self._pid == os.getpid() and self._thread.is_alive():
+            self._queue.join()
+
+    def close(self) -> None:
+        """write all the queued records and stop the writer thread, called by logging.shutdown() at exit"""
+        if self._pid == os.getpid() and self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join(timeout=10)
+        [handler.close() for handler in self.handlers]
+        super().close()
+
+
+def enable_async_logging(logger, queue_size=10000, policy='drop', batch_size=200):
+    """Replace the handlers of `logger` with an AsyncLogHandler writes into them"""
+    if not logger.handlers or any(isinstance(handler, AsyncLogHandler) for handler in logger.handlers):
+        return
+    handler = AsyncLogHandler(list(logger.handlers), queue_size, policy, batch_size)
+    for item in list(logger.handlers):
+        logger.removeHandler(item)
+    logger.addHandler(handler)
+    return handler
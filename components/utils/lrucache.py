@@ -0,0 +1,86 @@
+import sys
+import time
+from collections import OrderedDict
+
+
+def estimate_size(value):
+    """rough memory usage (bytes) of value, goes into list/tuple/dict one level deep per level,
+    other objects are sized by sys.getsizeof(), i.e. their __sizeof__()
+    """
+    size = sys.getsizeof(value)
+    nbytes = getattr(value, 'nbytes', None)
+    if isinstance(nbytes, int):
+        # numpy array / memoryview: getsizeof() misses the buffer of a view
+        size = max(size, nbytes)
+    if isinstance(value, dict):
+        size += sum(estimate_size(k) + estimate_size(v) for k, v in value.items())
+    elif isinstance(value, (list, tuple, set)):
+        size += sum(estimate_size(item) for item in value)
+    return size
+
+
+class LRUCache():
+    """LRU cache bounded by the total estimated size (bytes) of the values, entries expire after ttl seconds.
+    `on_evict(key)` is called when an entry is removed by the size limit or expiry.
+    """
+
+    def __init__(self, max_size, ttl=60, on_evict=None) -> None:
+        self.max_size = max_size
+        self.ttl = ttl
+        self.on_evict = on_evict
+        self.size = 0
+        self.hits = self.misses = self.evictions = 0
+        # key -> [expire_at, size, value]
+        self._data = OrderedDict()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return self.get(key, count=False) is not None
+
+    def get(self, key, default=None, count=True):
+        entry = self._data.get(key)
+        if entry is not None and entry[0] < time.time():
+            self._remove(key, evicted=True)
+            entry = None
+        if entry is None:
+            self.misses += count
+            return default
+        self._data.move_to_end(key)
+        self.hits += count
+        return entry[2]
+
+    def set(self, key, value, ttl=None, size=None):
+        size = estimate_size(value) if size is None else size
+        if size > self.max_size:
+            return False
+        if key in self._data:
+            self._remove(key)
+        self._data[key] = [time.time() + (self.ttl if ttl is None else ttl), size, value]
+        self.size += size
+        while self.size > self.max_size:
+            self._remove(next(iter(self._data)), evicted=True)
+        return True
+
+    def pop(self, key):
+        if key in self._data:
+            return self._remove(key)
+        return None
+
+    def clear(self):
+        self._data.clear()
+        self.size = 0
+
+    def _remove(self, key, evicted=False):
+        _, size, value = self._data.pop(key)
+        self.size -= size
+        if evicted:
+            self.evictions += 1
+            if self.on_evict:
+                self.on_evict(key)
+        return value
+
+    def stats(self):
+        return {'entries': len(self._data), 'size': self.size, 'max_size': self.max_size,
+                'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
@@ -0,0 +1,190 @@
+"""Request / DB / outbound http metrics, rendered in prometheus text format.
+
+Every process records into its own `metrics`. With forks, call `metrics.share(processes)` before
+fork: the processes publish their snapshots into the slots of an anonymous shared memory
+segment periodically, the process serving the scrape merges all slots, one scrape sees the whole pod.
+"""
+import bisect
+import logging
+import mmap
+import os
+import struct
+import time
+from contextlib import contextmanager
+
+import ujson as json
+from tornado.ioloop import PeriodicCallback
+from tornado.process import task_id
+
+# seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class SharedSlots():
+    """Fixed size slots in an anonymous shared memory segment, it must be created before fork.
+    slot layout: sequence(uint32) length(uint32) data, the writer makes sequence odd while writing
+    """
+    HEADER = struct.Struct('II')
+
+    def __init__(self, slots, slot_size) -> None:
+        self.slots = slots
+        self.slot_size = slot_size
+        self._mm = mmap.mmap(-1, slots * slot_size)
+
+    def write(self, slot, data):
+        if len(data) > self.slot_size - SharedSlots.HEADER.size:
+            raise ValueError('%d bytes exceed the slot size %d' % (len(data), self.slot_size))
+        offset = slot * self.slot_size
+        sequence, _ = SharedSlots.HEADER.unpack_from(self._mm, offset)
+        SharedSlots.HEADER.pack_into(self._mm, offset, sequence + 1, 0)
+        self._mm[offset + SharedSlots.HEADER.size: offset + SharedSlots.HEADER.size + len(data)] = data
+        SharedSlots.HEADER.pack_into(self._mm, offset, sequence + 2, len(data))
+
+    def read(self, slot, retry=10):
+        offset = slot * self.slot_size
+        for _ in range(retry):
+            sequence, length = SharedSlots.HEADER.unpack_from(self._mm, offset)
+            if sequence % 2:
+                time.sleep(0.001)
+                continue
+            data = self._mm[offset + SharedSlots.HEADER.size: offset + SharedSlots.HEADER.size + length]
+            if SharedSlots.HEADER.unpack_from(self._mm, offset)[0] == sequence:
+                return data
+        return b''
+
+
+class Metrics():
+
+    def __init__(self, buckets=LATENCY_BUCKETS) -> None:
+        self.buckets = buckets
+        # (name, ((label, value),...)) -> value / [bucket counts..., sum]
+        self._counters = {}
+        self._histograms = {}
+        self._shared = None
+        self._pid = None
+        self._publisher = None
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        """add `value` (seconds) into the histogram `name`"""
+        if self._shared and self._pid != os.getpid():
+            self._start_publish()
+        key = (name, tuple(sorted(labels.items())))
+        histogram = self._histograms.get(key)
+        if histogram is None:
+            histogram = self._histograms[key] = [0] * (len(self.buckets) + 2)
+        histogram[bisect.bisect_left(self.buckets, value)] += 1
+        histogram[-1] += value
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """observe the time usage of the with block, label `result` is ok or error"""
+        start, result = time.time(), 'ok'
+        try:
+            yield
+        except BaseException:
+            result = 'error'
+            raise
+        finally:
+            self.observe(name, time.time() - start, result=result, **labels)
+
+    def observe_request(self, handler):
+        self.observe('http_request_duration_seconds', handler.request.request_time(),
+                     handler='%s.%s' % (handler.__module__, handler.__class__.__name__),
+                     method=handler.request.method,
+                     status=handler.get_status())
+
+    # ---- share between forked processes ----
+    def share(self, processes, slot_size=256 * 1024, interval=5):
+        """create the shared memory for `processes` forked processes, call it before fork"""
+        self._shared = SharedSlots(max(processes, 1), slot_size)
+        self._interval = interval
+
+    def _start_publish(self):
+        # called in the forked process, start publishing the snapshot periodically
+        self._pid = os.getpid()
+        self._counters.clear()
+        self._histograms.clear()
+        self._publisher = PeriodicCallback(self.publish, self._interval * 1000)
+        self._publisher.start()
+
+    def publish(self):
+        slot = task_id() or 0
+        if not self._shared or slot >= self._shared.slots:
+            return
+        try:
+            self._shared.write(slot, json.dumps(self.snapshot()).encode('utf-8'))
+        except ValueError as e:
+            logging.getLogger().warning('metrics not published: %s' % e)
+
+    def snapshot(self):
+        return {
+            'counters': [[name, list(labels), value] for (name, labels), value in self._counters.items()],
+            'histograms': [[name, list(labels), value] for (name, labels), value in self._histograms.items()],
+        }
+
+    def collect(self):
+        """the snapshots of all processes"""
+        if not self._shared:
+            return [self.snapshot()]
+        self.publish()
+        snapshots = []
+        for slot in range(self._shared.slots):
+            data = self._shared.read(slot)
+            if data:
+                snapshots.append(json.loads(data))
+        return snapshots
+
+    # ---- prometheus text ----
+    def render(self):
+        counters, histograms = {}, {}
+        for snapshot in self.collect():
+            for name, labels, value in snapshot['counters']:
+                key = (name, tuple(tuple(item) for item in labels))
+                counters[key] = counters.get(key, 0) + value
+            for name, labels, value in snapshot['histograms']:
+                key = (name, tuple(tuple(item) for item in labels))
+                merged = histograms.get(key)
+                histograms[key] = value if merged is None else [a + b for a, b in zip(merged, value)]
+
+        lines, typed = [], set()
+        for (name, labels), value in sorted(counters.items()):
+            if name not in typed:
+                typed.add(name)
+                lines.append('# TYPE %s counter' % name)
+            lines.append('%s%s %s' % (name, _labels(labels), value))
+
+        for (name, labels), value in sorted(histograms.items()):
+            if name not in typed:
+                typed.add(name)
+                lines.append('# TYPE %s histogram' % name)
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), value[:-1]):
+                cumulative += count
+                lines.append('%s_bucket%s %d' % (name, _labels(labels + (('le', bound),)), cumulative))
+            lines.append('%s_sum%s %f' % (name, _labels(labels), value[-1]))
+            lines.append('%s_count%s %d' % (name, _labels(labels), cumulative))
+        return '\n'.join(lines) + '\n'
+
+
+def percentiles(values, points=(50, 95, 99)):
+    """{'p50': .., 'p95': .., 'p99': .., 'max': ..} of the values, nearest-rank"""
+    values = sorted(values)
+    if not values:
+        return {}
+    result = {'p%d' % point: values[min(len(values) - 1, int(len(values) * point / 100))] for point in points}
+    result['max'] = values[-1]
+    return result
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+                             for k, v in labels)
+
+
+metrics = Metrics()
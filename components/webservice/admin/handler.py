@@ -0,0 +1,79 @@
+import tornado.web
+from tornado.options import options
+
+from components.basehandler import responsecache
+from components.basehandler.basehandler import DefaultHandler
+from components.database.mysqldb import MySqlDB
+from components.database.sqlstats import sql_stats
+from components.utils.metrics import metrics
+
+
+class MetricsHandler(DefaultHandler):
+    """prometheus scrape endpoint, merged metrics of all the forked processes"""
+
+    def get(self):
+        self.set_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.write(metrics.render())
+
+
+class ReadinessHandler(DefaultHandler):
+    """readiness probe, 503 until the startup prewarm succeeded"""
+
+    def get(self):
+        readiness = self.application.readiness
+        self.set_status(200 if readiness['ready'] else 503)
+        self.write(readiness)
+
+
+class PoolStatsHandler(DefaultHandler):
+    """statistics of the mysql connection pool in the process serving the request"""
+
+    @tornado.web.authenticated
+    def get(self):
+        self.write(MySqlDB._conn_pool.stats() if MySqlDB._conn_pool else {})
+
+
+class QueryCacheStatsHandler(DefaultHandler):
+    """hit / miss / size of the exec_select result cache in the process serving the request"""
+
+    @tornado.web.authenticated
+    def get(self):
+        self.write(MySqlDB._query_cache.stats() if MySqlDB._query_cache else {})
+
+
+class ResponseCacheStatsHandler(DefaultHandler):
+    """hit / miss / size of the @cache_response cache in the process serving the request, DELETE to clear"""
+
+    @tornado.web.authenticated
+    def get(self):
+        self.write(responsecache._cache.stats() if responsecache._cache else {})
+
+    @tornado.web.authenticated
+    def delete(self):
+        if responsecache._cache:
+            responsecache._cache.clear()
+        self.write({})
+
+
+class SqlStatsHandler(DefaultHandler):
+    """statistics per sql fingerprint in the process serving the request
+    ?order=total_time|count|p99|slow|rows&top=50, DELETE to reset
+    """
+
+    @tornado.web.authenticated
+    def get(self):
+        self.write(sql_stats.stats(self.get_argument('order', 'total_time'), int(self.get_argument('top', 50))))
+
+    @tornado.web.authenticated
+    def delete(self):
+        sql_stats.reset()
+        self.write({'since': sql_stats.since})
+
+
+handler_map = [
+    (r'/ready', ReadinessHandler),
+    (r'/admin/pool', PoolStatsHandler),
+    (r'/admin/query_cache', QueryCacheStatsHandler),
+    (r'/admin/sql_stats', SqlStatsHandler),
+    (r'/admin/response_cache', ResponseCacheStatsHandler),
+] + ([(options.metrics_path, MetricsHandler)] if options.metrics_path else [])
@@ -5,8 +5,11 @@ import tornado.auth
 from tornado.web import RequestHandler
 from tornado import httpclient
 from components.basehandler.basehandler import *
+from components.basehandler.exporthandler import ExportMixin
 from components.database.mysqldb import MySqlDB
+from components.utils.metrics import metrics
 from components.utils.misc import guid
+from urllib.parse import urlparse
 
 class HelloHandler(UIHandler):
 
@@ -30,10 +33,10 @@ class DBHandler(UIHandler):
     # http actions: get/head/post/delete/patch/put/options
     async def get(self):
         try:
-            db = MySqlDB(self.application.settings['mysql_config'])            
+            db = self.db
             await db.exec_sql('create database if not exists linku_ems')
+            db.change_db('linku_ems')
             await db.exec_sql("""
-            use linku_ems; 
             drop table if exists tblaccount;
             create table if not exists tblaccount(
                 oid int unsigned auto_increment, 
@@ -47,6 +50,15 @@ class DBHandler(UIHandler):
             self.log.exception(ex)
             self.write(ex)        
 
+class ExportHandler(ExportMixin, DefaultHandler):
+
+    # /db/export?format=csv
+    async def get(self):
+        self.db.change_db('linku_ems')
+        format = self.get_argument('format', 'ndjson')
+        await self.export(self.db.iter_select('select oid, guid, account_name from tblaccount', as_chunks=True),
+                          format, 'tblaccount.%s' % format)
+
 class SpiderHandler(DefaultHandler):
     @tornado.web.authenticated
     async def get(self):
@@ -56,8 +68,10 @@ class SpiderHandler(DefaultHandler):
             self.write('没有指定url')
             return
         http_client = httpclient.AsyncHTTPClient()
+        url = ('https://' if url[0].startswith('http') else '') + url[0]
         try:
-            response = await http_client.fetch(('https://' if url[0].startswith('http') else '') + url[0])
+            with metrics.timer('http_client_duration_seconds', host=urlparse(url).netloc):
+                response = await http_client.fetch(url)
         except Exception as e:
             print("Error: %s" % e)
             self.write_error(400, **{"error": e.args})
@@ -102,4 +116,5 @@ handler_map = [
     (r'/redirect/(?P<url>.+)', RedirectHandler),
     (r'/auth/(?P<service>.+)', OpenAuthHandler), 
     (r'/db', DBHandler), 
+    (r'/db/export', ExportHandler),
 ]
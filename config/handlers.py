@@ -2,6 +2,7 @@ handler_list = [
         'components.webservice.helloworld.handler',
         # 'components.webservice.wechat.handler',
         'components.basehandler.authentication',
+        'components.webservice.admin.handler',
         # add the fall-over handler for default handling of 404 not found
         'components.basehandler.webapp'
     ]
\ No newline at end of file
@@ -14,7 +14,24 @@ define_options = (
     ("forks", 0, int, "fork process to use all cpu core"),
     ("compress_response", True, bool, "compress response content"),
     ("login_url", "/login", str, "the url will be used to redirect for user login"),
-    ("mysql_config", "", dict, "the mysql database config"))
+    ("mysql_config", "", dict, "the mysql database config"),
+    ("mysql_pool_config", {}, dict, "the mysql connection pool config, merged into mysql_config"),
+    ("mysql_shards", {}, dict, "shard name -> mysql config of ShardedMySqlDB, mysql_pool_config merged into each"),
+    ("max_body_size", 100*1024*1024, int, "max request body size of StreamHandler"),
+    ("upload_dir", "", str, "folder to save the uploaded files of StreamHandler"),
+    ("log_async", False, bool, "write log in background thread"),
+    ("log_queue_size", 10000, int, "max log records waiting to be written in async log mode"),
+    ("log_queue_policy", "drop", str, "drop / block when the async log queue is full"),
+    ("log_batch_size", 200, int, "max log records written at one time in async log mode"),
+    ("access_log_format", "compact", str, "compact: one line per request / web_api_test: postman style json, for debug"),
+    ("access_log_sample_rate", 1, int, "log 1 in N requests with status < 400, 0: never, 4xx/5xx are always logged"),
+    ("access_log_slow_time", 0.0, float, "requests slower than it (seconds) are always logged, 0: disabled"),
+    ("access_log_route_config", {}, dict, "per handler sample_rate/slow_time: {'module.HandlerClass': {'sample_rate': 1}}"),
+    ("metrics_path", "/metrics", str, "url of prometheus metrics, empty: disabled"),
+    ("metrics_slot_size", 256*1024, int, "shared memory size per process to publish metrics with forks"),
+    ("slow_query_log_file", "", str, "file of the slow query log, empty: into the app log"),
+    ("shutdown_timeout", 30.0, float, "seconds to flush the buffers when stopped by SIGTERM"),
+    ("response_cache_size", 64*1024*1024, int, "bytes of the responses cached by @cache_response per process"))
 #############################################################################
 
 # tornado settings NOT  MODULE SETTINGS
@@ -36,6 +53,12 @@ debug = True if any(
 
 
 # log config
+access_log_format = 'web_api_test' if debug else 'compact'
+access_log_sample_rate = 1 if debug else 100
+access_log_slow_time = 1.0
+access_log_route_config = {
+    # 'components.webservice.helloworld.handler.DBHandler': {'sample_rate': 1, 'slow_time': 0.2},
+}
 log_rotate_mode = 'size'  # time or size
 log_file_max_size = 20*1024*1024
 log_file_num_backups = 100
@@ -49,13 +72,52 @@ log_to_stderr = True if any(
 
 createDirIfNotExists(log_dir)
 
+# statements slower than slow_query_time (mysql config) are logged here
+slow_query_log_file = f'{log_dir}/slow_query'
+
+# format and write log in a background thread, the IOLoop will not wait for the nas
+log_async = False
+log_queue_size = 10000
+log_queue_policy = 'drop'   # drop or block when the queue is full
+log_batch_size = 200
+
+# request body streaming (StreamHandler)
+max_body_size = 1024*1024*1024
+upload_dir = './upload' if os.name == 'nt' else '/nas/upload'
+
+# prometheus metrics
+metrics_path = '/metrics'
+metrics_slot_size = 256*1024
+
 mysql_pool_config={
     'pool_max_size':20,
-    'pool_recycle_time': 60
+    'pool_recycle_time': 60,
+    'pool_idle_timeout': 300,   # close free connections beyond pool_min_size idle for seconds
+    'pool_reap_interval': 10,   # seconds between the background health checks
+    'pool_acquire_timeout': 5,  # seconds waiting for a free connection before PoolExhaustedError
+    'pool_min_size': 2,         # connections opened per process at startup
+    'pool_share_db': False,     # True: the dbs of a server share one pool, the db is switched on checkout
+    'pool_prewarm_timeout': 10,
+    'query_cache_size': 0,      # bytes of exec_select results cached per process, 0: disabled
+    'query_cache_ttl': 30,
+    'query_single_flight': False,   # identical exec_select at the same time share one execution
+    'replica_strategy': 'round_robin',  # or least_used, how exec_select picks a replica
+    'replica_fallback': True,   # read from the primary if the replica can not be connected
+    'slow_query_time': 1.0,     # seconds, statements slower than it go into the slow query log, 0: disabled
+    'write_behind_batch_size': 500,     # MySqlDB.insert_behind: rows per insert statement
+    'write_behind_max_latency': 1.0,    # seconds a queued row waits at most
+    'write_behind_max_rows': 50000,     # rows queued per table, insert_behind waits when full
+}
+# ShardedMySqlDB(settings['mysql_shards']), the shard names are hashed: do not rename them
+mysql_shards={
+    # 'shard0': {'host': '127.0.0.1', 'port': 3306, 'user': 'root', 'password': '', 'db': 'linku_ems'},
+    # 'shard1': {'host': '127.0.0.1', 'port': 3307, 'user': 'root', 'password': '', 'db': 'linku_ems'},
 }
 mysql_config={
     'host':'rm-uf642102c6905a2xneo.mysql.rds.aliyuncs.com',
     'port':3306,
     'user':'linku',
-    'password':'linku!@#$4321'
+    'password':'linku!@#$4321',
+    # exec_select / iter_select read from the replicas, each item overrides the primary config
+    # 'replicas': [{'host': 'rr-uf6xxxxxxxxxxxxxx.mysql.rds.aliyuncs.com'}],
 }
\ No newline at end of file
@@ -2,17 +2,24 @@
 # -*- coding: utf-8 -*-
 
 import logging
+import logging.handlers
+import os
+import signal
 from collections import defaultdict
 
 import tornado.httpserver
 import tornado.ioloop
 import tornado.log
+import tornado.netutil
+import tornado.process
 import tornado.web
 from tornado.options import define, options
 from tornado.web import Application, RequestHandler
 
 from components.basehandler.webapp import (AppLogger, IPAApplication,
                                            LogFormatter)
+from components.utils.log import enable_async_logging
+from components.utils.metrics import metrics
 from components.utils.misc import createIfNotExists
 
 SERVER_CONFIG = "./config/server_config.py"
@@ -27,6 +34,18 @@ def make_app():
     # remove: this will call tornado.log.enable_pretty_logging twice and create duplicate handlers
     # options.parse_command_line()    # command line own the top priority
     [i.setFormatter(LogFormatter()) for i in logging.getLogger().handlers]
+    if options.slow_query_log_file:
+        # slow queries in their own file instead of the app log
+        slow_log = logging.getLogger('slow_query')
+        slow_log.propagate = False
+        handler = logging.handlers.RotatingFileHandler(options.slow_query_log_file, maxBytes=options.log_file_max_size,
+                                                       backupCount=options.log_file_num_backups, encoding='utf-8')
+        handler.setFormatter(LogFormatter())
+        slow_log.addHandler(handler)
+    if options.log_async:
+        for logger in (logging.getLogger(), logging.getLogger('slow_query')):
+            enable_async_logging(logger, options.log_queue_size,
+                                 options.log_queue_policy, options.log_batch_size)
 
     handler_map = []
     # add more handler file here
@@ -35,7 +54,17 @@ def make_app():
         exec(f'from {handler} import handler_map as handler_entry')
         exec(f'handler_map += handler_entry')
 
-    app = IPAApplication(handler_map, **options.as_dict())
+    settings = options.as_dict()
+    if settings['mysql_config']:
+        settings['mysql_config'] = dict(settings['mysql_pool_config'], **settings['mysql_config'])
+    settings['mysql_shards'] = {name: dict(settings['mysql_pool_config'], **config)
+                                for name, config in (settings['mysql_shards'] or {}).items()}
+    app = IPAApplication(handler_map, **settings)
+
+    # forked processes publish their metrics into shared memory, one scrape get the whole pod
+    forks = options.forks if options.forks > 0 else tornado.process.cpu_count()
+    if forks > 1:
+        metrics.share(forks, options.metrics_slot_size)
 
     # change to defaultdict, much more easier latter
     def NotExist():
@@ -47,11 +76,28 @@ def make_app():
 #############################################################################
 if __name__ == "__main__":
     app = make_app()
+    sockets = tornado.netutil.bind_sockets(app.settings.get('port', 80),
+                                           address=app.settings.get('address', ''))
+    if app.settings.get('forks', 1) != 1:
+        # the parent only watches the children: pass SIGTERM to them, it exits after they all exit
+        def forward_signal(signum, frame):
+            signal.signal(signum, signal.SIG_IGN)
+            os.killpg(0, signum)
+        signal.signal(signal.SIGTERM, forward_signal)
+        tornado.process.fork_processes(app.settings.get('forks', 1))  # forks one process per cpu
     server = tornado.httpserver.HTTPServer(app)
-    server.listen(app.settings.get('port', 80),
-                  address=app.settings.get('address', ''))
-    server.start(app.settings.get('forks', 1))  # forks one process per cpu
-    
+
     io = tornado.ioloop.IOLoop.current()
+
+    # SIGTERM: stop accepting requests, flush the buffers, then exit
+    async def shutdown():
+        server.stop()
+        await app.shutdown()
+        io.stop()
+    signal.signal(signal.SIGTERM, lambda signum, frame: io.add_callback_from_signal(shutdown))
+
+    # connect to the databases in every process before the sockets accept requests
+    io.run_sync(app.prewarm)
+    server.add_sockets(sockets)
     io.add_callback(app.execute_start_command)    
     io.start()
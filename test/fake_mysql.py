@@ -0,0 +1,137 @@
+"""fake aiomysql connections for the tests of components.database, patched into mysqlpool.connect:
+    patch_connect(self, rows)
+`rows(conn, sql)` returns the dict rows of a statement, default: [{'host': conn.host}]
+"""
+import asyncio
+from unittest import mock
+
+import aiomysql
+from pymysql.converters import escape_item
+
+from components.database import mysqlpool
+
+# hosts refusing connections
+DOWN_HOSTS = set()
+# connections opened
+CONNECTIONS = []
+
+
+def host_rows(conn, sql):
+    return [{'host': conn.host}]
+
+
+class FakeCursor():
+
+    def __init__(self, conn) -> None:
+        self.conn = conn
+        self.description = None
+        self._rows = []
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        pass
+
+    def __await__(self):
+        # `await conn.cursor()` as well as `async with conn.cursor()`, like aiomysql
+        yield from asyncio.sleep(0).__await__()
+        return self
+
+    async def execute(self, sql, params=None):
+        # let the other tasks run, as a round trip would
+        await asyncio.sleep(0)
+        self.conn.executed.append(sql)
+        self._rows = self.conn.rows(self.conn, sql) or []
+        self.description = tuple((column,) for column in self._rows[0]) if self._rows else None
+        return len(self._rows) or 1
+
+    async def executemany(self, sql, args):
+        for params in args:
+            await self.execute(sql, params)
+        return len(args)
+
+    async def callproc(self, proc_name, args=()):
+        await self.execute('call %s' % proc_name, args)
+        return args
+
+    async def fetchmany(self, size):
+        rows, self._rows = self._rows, []
+        return rows
+
+    async def nextset(self):
+        return False
+
+    async def close(self):
+        pass
+
+
+class FakeReader():
+
+    def at_eof(self):
+        return False
+
+    def exception(self):
+        return None
+
+
+class FakeConnection():
+    """the part of aiomysql.Connection used by the pool and MySqlDB"""
+
+    def __init__(self, host, port, user, db, rows=host_rows, **kwargs) -> None:
+        self.host, self.port, self.user, self._db = host, port, user, db
+        self.rows = rows
+        self.kwargs = kwargs
+        self.closed = False
+        self.executed = []
+        self._reader = FakeReader()
+        self._in_transaction = False
+        self.last_usage = 0
+
+    @property
+    def db(self):
+        return self._db
+
+    def cursor(self, cursor_class=None):
+        return FakeCursor(self)
+
+    def escape(self, value):
+        return escape_item(value, 'utf8mb4')
+
+    async def select_db(self, db):
+        self.executed.append('use %s' % db)
+        self._db = db
+
+    async def begin(self):
+        self._in_transaction = True
+
+    async def commit(self):
+        self._in_transaction = False
+
+    async def rollback(self):
+        self._in_transaction = False
+
+    def get_transaction_status(self):
+        return self._in_transaction
+
+    def close(self):
+        self.closed = True
+
+    async def ensure_closed(self):
+        self.closed = True
+
+
+def patch_connect(test, rows=host_rows):
+    """patch mysqlpool.connect with fake connections for the test case, until its cleanup"""
+    async def fake_connect(host='localhost', port=3306, user=None, db=None, loop=None, echo=False, **kwargs):
+        if host in DOWN_HOSTS:
+            raise aiomysql.OperationalError(2003, "Can't connect to MySQL server on '%s'" % host)
+        conn = FakeConnection(host, port, user, db, rows, **kwargs)
+        CONNECTIONS.append(conn)
+        return conn
+
+    DOWN_HOSTS.clear()
+    CONNECTIONS.clear()
+    patcher = mock.patch.object(mysqlpool, 'connect', fake_connect)
+    patcher.start()
+    test.addCleanup(patcher.stop)
@@ -0,0 +1,115 @@
+"""read / write splitting of MySqlDB (replicas, round robin, fallback, read your writes) on fake connections:
+    python -m unittest discover -s test
+"""
+import asyncio
+import unittest
+
+import aiomysql
+
+from components.database.mysqldb import MySqlDB
+from fake_mysql import DOWN_HOSTS, patch_connect
+
+
+CONFIG = {'host': 'primary', 'port': 3306, 'user': 'test', 'db': 'test', 'pool_reap_interval': 0,
+          'replicas': [{'host': 'replica1'}, {'host': 'replica2'}]}
+
+
+class ReadRoutingTest(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        patch_connect(self)
+        MySqlDB._conn_pool = None
+        MySqlDB._replica_turn = 0
+        MySqlDB._query_cache = None
+        self.dbs = []
+
+    async def asyncTearDown(self):
+        for db in self.dbs:
+            db.release()
+        MySqlDB._conn_pool.terminate()
+        MySqlDB._conn_pool = None
+        MySqlDB._query_cache = None
+
+    def new_db(self, **config):
+        db = MySqlDB(dict(CONFIG, **config))
+        self.dbs.append(db)
+        return db
+
+    async def read_host(self, db, **kwargs):
+        return (await db.exec_select('select @@hostname as host', **kwargs))[0]['host']
+
+    async def test_round_robin(self):
+        hosts = [await self.read_host(self.new_db()) for _ in range(4)]
+        self.assertEqual(hosts, ['replica2', 'replica1', 'replica2', 'replica1'])
+
+    async def test_replica_kept_by_object(self):
+        db = self.new_db()
+        first = await self.read_host(db)
+        self.assertEqual([await self.read_host(db) for _ in range(3)], [first] * 3)
+
+    async def test_least_used(self):
+        busy, done = self.new_db(), self.new_db()
+        self.assertEqual(await self.read_host(busy), 'replica2')
+        self.assertEqual(await self.read_host(done), 'replica1')
+        done.release()
+        # round robin would pick replica2, which has a connection in use
+        self.assertEqual(await self.read_host(self.new_db(replica_strategy='least_used')), 'replica1')
+
+    async def test_no_replica(self):
+        db = self.new_db(replicas=[])
+        self.assertEqual(await self.read_host(db), 'primary')
+
+    async def test_force_primary(self):
+        db = self.new_db()
+        self.assertEqual(await self.read_host(db, force_primary=True), 'primary')
+
+    async def test_transaction_on_primary(self):
+        db = self.new_db()
+        async with db.transaction():
+            self.assertEqual(await self.read_host(db), 'primary')
+        self.assertNotEqual(await self.read_host(db), 'primary')
+
+    async def test_fallback_to_primary(self):
+        DOWN_HOSTS.update({'replica1', 'replica2'})
+        db = self.new_db()
+        with self.assertLogs(level='WARNING'):
+            self.assertEqual(await self.read_host(db), 'primary')
+
+    async def test_fallback_disabled(self):
+        DOWN_HOSTS.add('replica2')
+        db = self.new_db(replica_fallback=False)
+        with self.assertRaises(aiomysql.OperationalError):
+            await self.read_host(db)
+
+    async def test_read_your_writes(self):
+        db = self.new_db()
+        self.assertNotEqual(await self.read_host(db), 'primary')
+        await db.exec_sql('update tbluser set name=%s where id=%s', ('a', 1))
+        self.assertEqual(await self.read_host(db), 'primary')
+        db.release()
+        self.assertNotEqual(await self.read_host(db), 'primary')
+
+    async def test_read_your_writes_cached(self):
+        writer, reader = self.new_db(query_cache_size=1024 * 1024), self.new_db(query_cache_size=1024 * 1024)
+        await writer.exec_sql('update tbluser set name=%s where id=%s', ('a', 1))
+        self.assertNotEqual((await reader.exec_select('select host from tbluser'))[0]['host'], 'primary')
+        self.assertEqual((await writer.exec_select('select host from tbluser'))[0]['host'], 'primary')
+
+    async def test_read_your_writes_single_flight(self):
+        writer, reader = self.new_db(), self.new_db()
+        await writer.exec_sql('update tbluser set name=%s where id=%s', ('a', 1))
+        # the reader leads the select on a replica, the writer does not join it
+        rows = await asyncio.gather(reader.exec_select('select host from tbluser', single_flight=True),
+                                    writer.exec_select('select host from tbluser', single_flight=True))
+        self.assertNotEqual(rows[0][0]['host'], 'primary')
+        self.assertEqual(rows[1][0]['host'], 'primary')
+
+    async def test_write_batch_on_primary(self):
+        db = self.new_db()
+        results = await db.exec_multi('select 1 as host; update tbluser set name=name')
+        self.assertEqual(results[0][0]['host'], 'primary')
+        self.assertEqual(await self.read_host(db), 'primary')
+
+
+if __name__ == '__main__':
+    unittest.main()
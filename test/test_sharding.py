@@ -0,0 +1,135 @@
+"""HashRing and ShardedMySqlDB on fake connections:
+    python -m unittest discover -s test
+"""
+import unittest
+from collections import Counter
+
+from components.basehandler.webapp import IPAApplication
+from components.database.mysqldb import MySqlDB
+from components.database.sharding import HashRing, ShardedMySqlDB
+from fake_mysql import CONNECTIONS, DOWN_HOSTS, patch_connect
+
+# host -> rows returned by a select on it
+ROWS = {}
+
+
+def shard_rows(conn, sql):
+    if 'max_allowed_packet' in sql:
+        return [{'max_allowed_packet': 1024 * 1024}]
+    if sql.lstrip().lower().startswith('select'):
+        return [dict(row) for row in ROWS.get(conn.host, [])]
+    return []
+
+
+SHARDS = {name: {'host': name, 'port': 3306, 'user': 'test', 'db': 'test', 'pool_reap_interval': 0}
+          for name in ('shard1', 'shard2', 'shard3')}
+
+
+class HashRingTest(unittest.TestCase):
+
+    def test_distribution(self):
+        ring = HashRing(['a', 'b', 'c', 'd'])
+        counts = Counter(ring.node(key) for key in range(20000))
+        self.assertEqual(set(counts), {'a', 'b', 'c', 'd'})
+        for count in counts.values():
+            self.assertTrue(20000 / 4 * 0.75 < count < 20000 / 4 * 1.25, counts)
+
+    def test_stable(self):
+        ring, same = HashRing(['a', 'b', 'c']), HashRing(['c', 'b', 'a'])
+        self.assertEqual([ring.node(key) for key in range(1000)], [same.node(key) for key in range(1000)])
+
+    def test_add_node_moves_its_share_only(self):
+        before, after = HashRing(['a', 'b', 'c', 'd']), HashRing(['a', 'b', 'c', 'd', 'e'])
+        moved = [key for key in range(20000) if before.node(key) != after.node(key)]
+        # only to the new node, about 1/5 of the keys
+        self.assertEqual({after.node(key) for key in moved}, {'e'})
+        self.assertTrue(0.1 < len(moved) / 20000 < 0.3, len(moved))
+
+    def test_remove_node_moves_its_keys_only(self):
+        before, after = HashRing(['a', 'b', 'c']), HashRing(['a', 'b'])
+        for key in range(5000):
+            if before.node(key) != 'c':
+                self.assertEqual(before.node(key), after.node(key))
+
+    def test_empty(self):
+        with self.assertRaises(ValueError):
+            HashRing([]).node(1)
+
+
+class ShardedMySqlDBTest(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        patch_connect(self, shard_rows)
+        ROWS.clear()
+        MySqlDB._conn_pool = None
+        self.db = ShardedMySqlDB(SHARDS)
+
+    async def asyncTearDown(self):
+        self.db.release()
+        MySqlDB._conn_pool.terminate()
+        MySqlDB._conn_pool = None
+
+    def executed(self, host):
+        return [sql for conn in CONNECTIONS if conn.host == host for sql in conn.executed]
+
+    async def test_routing(self):
+        for key in range(20):
+            ROWS.clear()
+            ROWS[self.db.shard_of(key)] = [{'id': key}]
+            self.assertEqual(await self.db.exec_select('select * from tblorder where uid=%s', key, params=(key,)),
+                             [{'id': key}])
+
+    async def test_shard_connections_autocommit(self):
+        await self.db.exec_sql_all('update tblorder set status=1')
+        self.assertEqual({conn.host for conn in CONNECTIONS}, set(SHARDS))
+        for conn in CONNECTIONS:
+            self.assertEqual(conn.kwargs.get('autocommit'), True)
+            self.assertEqual(conn.kwargs.get('charset'), 'utf8mb4')
+
+    async def test_select_all_merge(self):
+        ROWS.update({'shard1': [{'id': 1}, {'id': 6}], 'shard2': [{'id': 4}], 'shard3': [{'id': 2}, {'id': 5}]})
+        rows = await self.db.exec_select_all('select id from tblorder order by id desc limit 3',
+                                             order_by='id', reverse=True, limit=3)
+        self.assertEqual(rows, [{'id': 6}, {'id': 5}, {'id': 4}])
+        rows = await self.db.exec_select_all('select id from tblorder', order_by=lambda row: row['id'])
+        self.assertEqual([row['id'] for row in rows], [1, 2, 4, 5, 6])
+
+    async def test_fan_out_error(self):
+        async def fail(*args, **kwargs):
+            raise RuntimeError('shard2 down')
+        self.db.shards['shard2'].exec_select = fail
+        with self.assertRaises(RuntimeError):
+            await self.db.exec_select_all('select id from tblorder')
+        # the other shards still ran
+        self.assertTrue(self.executed('shard1') and self.executed('shard3'))
+
+    async def test_bulk_insert_grouped_by_shard(self):
+        rows = [{'uid': uid, 'amount': uid * 10} for uid in range(30)]
+        results = await self.db.bulk_insert('tblorder', rows, 'uid')
+        self.assertEqual(sum(result['rows'] for result in results.values()), 30)
+        for name, result in results.items():
+            inserts = [sql for sql in self.executed(name) if sql.startswith('INSERT')]
+            self.assertEqual(len(inserts), 1)
+            expected = sorted(uid for uid in range(30) if self.db.shard_of(uid) == name)
+            self.assertEqual(result['rows'], len(expected))
+            self.assertTrue(inserts[0].startswith('INSERT INTO tblorder(uid,amount) VALUES (%d,' % expected[0]))
+
+    async def test_prewarm(self):
+        DOWN_HOSTS.add('shard2')
+        app = IPAApplication(mysql_config=dict(SHARDS['shard1'], host='primary'),
+                             mysql_shards={name: dict(config, pool_prewarm_retry=3600)
+                                           for name, config in SHARDS.items()})
+        with self.assertLogs(level='ERROR'):
+            readiness = await app.prewarm()
+        self.assertFalse(readiness['ready'])
+        self.assertTrue(readiness['mysql']['ready'])
+        self.assertEqual({name: shard['ready'] for name, shard in readiness['mysql_shards'].items()},
+                         {'shard1': True, 'shard2': False, 'shard3': True})
+        self.assertEqual({conn.host for conn in CONNECTIONS}, {'primary', 'shard1', 'shard3'})
+
+        DOWN_HOSTS.clear()
+        self.assertTrue((await app.prewarm())['ready'])
+
+
+if __name__ == '__main__':
+    unittest.main()
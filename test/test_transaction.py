@@ -0,0 +1,79 @@
+"""MySqlDB transactions on fake connections:
+    python -m unittest discover -s test
+"""
+import unittest
+
+from components.database.mysqldb import DBProxyRuntimeException, MySqlDB
+from fake_mysql import CONNECTIONS, patch_connect
+
+CONFIG = {'host': 'primary', 'port': 3306, 'user': 'test', 'db': 'test', 'pool_reap_interval': 0}
+
+
+def rows(conn, sql):
+    if sql.startswith('call'):
+        return [{'id': 1}, {'id': 2}]
+    if sql.startswith('select'):
+        return [{'id': 1}]
+    return []
+
+
+class TransactionTest(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        patch_connect(self, rows)
+        MySqlDB._conn_pool = None
+        MySqlDB._query_cache = None
+        self.db = MySqlDB(dict(CONFIG, query_cache_size=1024 * 1024))
+
+    async def asyncTearDown(self):
+        self.db.release()
+        MySqlDB._conn_pool.terminate()
+        MySqlDB._conn_pool = None
+        MySqlDB._query_cache = None
+
+    async def test_statements_on_the_transaction_connection(self):
+        async with self.db.transaction():
+            await self.db.exec_sql('update tbluser set name=%s where id=%s', ('a', 1))
+            await self.db.executemany('insert into tbllog(uid) values (%s)', [(1,), (2,)])
+            self.assertEqual(await self.db.call_procedure('proc_summary', [1]), [{'id': 1}, {'id': 2}])
+            self.assertTrue(self.db.in_transaction)
+        self.assertEqual(len(CONNECTIONS), 1)
+        self.assertFalse(CONNECTIONS[0].closed)
+        self.assertEqual(CONNECTIONS[0].executed, ['update tbluser set name=%s where id=%s',
+                                                   'insert into tbllog(uid) values (%s)',
+                                                   'insert into tbllog(uid) values (%s)', 'call proc_summary'])
+
+    async def test_commit_lost_connection(self):
+        await self.db.begin()
+        CONNECTIONS[0].close()
+        with self.assertRaises(Exception):
+            await self.db.commit()
+        self.assertFalse(self.db.in_transaction)
+
+    async def test_executemany_invalidates(self):
+        await self.db.exec_select('select id from tbllog')
+        self.assertEqual(MySqlDB._query_cache.stats()['entries'], 1)
+        await self.db.executemany('insert into tbllog(uid) values (%s)', [(1,)])
+        self.assertEqual(MySqlDB._query_cache.stats()['entries'], 0)
+
+    async def test_release_deferred(self):
+        await self.db.begin()
+        await self.db.exec_sql('update tbluser set name=name')
+        self.db.release(defer=True)
+        self.assertTrue(self.db.in_transaction)
+        await self.db.commit()
+        self.assertEqual(MySqlDB._conn_pool.stats()['host-primary port-3306 db-test user-test']['in_use'], 0)
+        self.assertFalse(CONNECTIONS[0].closed)
+
+    async def test_iter_select_in_transaction(self):
+        async with self.db.transaction():
+            await self.db.exec_sql('update tbluser set name=%s where id=%s', ('a', 1))
+            with self.assertRaises(DBProxyRuntimeException):
+                async for _ in self.db.iter_select('select id from tbluser'):
+                    pass
+        self.assertEqual(len(CONNECTIONS), 1)
+        self.assertEqual([row async for row in self.db.iter_select('select id from tbluser')], [{'id': 1}])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,73 @@
+"""USE statements run by MySqlDB, with the connections pooled per db or shared by the dbs (pool_share_db):
+    python -m unittest discover -s test
+"""
+import unittest
+
+from components.database.mysqldb import MySqlDB
+from fake_mysql import CONNECTIONS, patch_connect
+
+CONFIG = {'host': 'primary', 'port': 3306, 'user': 'test', 'db': 'test', 'pool_reap_interval': 0}
+
+
+class UseStatementTest(unittest.IsolatedAsyncioTestCase):
+
+    share_db = False
+
+    async def asyncSetUp(self):
+        patch_connect(self)
+        MySqlDB._conn_pool = None
+
+    async def asyncTearDown(self):
+        MySqlDB._conn_pool.terminate()
+        MySqlDB._conn_pool = None
+
+    def new_db(self, **config):
+        return MySqlDB(dict(CONFIG, pool_share_db=self.share_db, **config))
+
+    async def test_per_db_pool(self):
+        db = self.new_db()
+        await db.exec_sql('use other; select 1')
+        # the same connection, still on the db selected
+        await db.exec_sql('select 1')
+        self.assertEqual(len(CONNECTIONS), 1)
+        db.release()
+        # pooled by its db, it is not reused for it
+        self.assertTrue(CONNECTIONS[0].closed)
+        self.assertEqual(MySqlDB._conn_pool.stats()['host-primary port-3306 db-test user-test']['in_use'], 0)
+
+        await db.exec_sql('select 1')
+        self.assertEqual(len(CONNECTIONS), 2)
+        self.assertEqual(CONNECTIONS[1].db, 'test')
+        db.release()
+
+    async def test_per_db_pool_exec_multi(self):
+        db = self.new_db()
+        await db.exec_multi('use other; update t set a=1')
+        db.release()
+        self.assertTrue(CONNECTIONS[0].closed)
+
+
+class SharedDbUseStatementTest(UseStatementTest):
+
+    share_db = True
+
+    async def test_shared_pool(self):
+        db = self.new_db()
+        await db.exec_sql('use other')
+        db.release()
+        self.assertFalse(CONNECTIONS[0].closed)
+
+        db = self.new_db()
+        await db.exec_sql('select 1')
+        # the connection is switched back to the db of the config
+        self.assertEqual(len(CONNECTIONS), 1)
+        self.assertEqual(CONNECTIONS[0].db, 'test')
+        self.assertEqual(CONNECTIONS[0].executed[-2:], ['use test', 'select 1'])
+        db.release()
+
+    # the connections are not pooled per db
+    test_per_db_pool = test_per_db_pool_exec_multi = None
+
+
+if __name__ == '__main__':
+    unittest.main()